@@ -4,6 +4,11 @@
 #   manga(manga_id, publication_status, Title, Author_name, synopsis, user_id, admin_id)
 import filetype , mimetypes
 import os, re, json, urllib.parse
+import functools, atexit
+from contextlib import contextmanager
+import io, mmap, struct, zipfile, zlib, gzip
+import brotli
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
 from flask import (
@@ -11,7 +16,7 @@ from flask import (
     request, flash, session, abort
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import send_file, Response
+from flask import send_file, Response, make_response
 import mysql.connector
 from mysql.connector import pooling
 import os, time, filetype
@@ -25,25 +30,68 @@ from flask import (
 
 
 import os, time
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 from flask import session, redirect, url_for, flash, request
 
 import re
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading, multiprocessing
+import click
+from flask.cli import AppGroup
+from jinja2 import nodes
+from jinja2.ext import Extension
+import hashlib, tempfile, shutil
+import pickle, socket
+from PIL import Image, ImageOps, features
+from flask import Request, template_rendered
+from werkzeug.datastructures import ContentRange
 
 
 
 # Config
 # ---------------------------
+class DiskSpooledRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # multipart file parts go straight to disk instead of up to 500 KB each in memory
+        return tempfile.TemporaryFile("wb+")
+
 app = Flask(__name__)
+app.request_class = DiskSpooledRequest
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-change-me')
 
-# uploads for forum images saved in DB as BLOB w
+# uploads for forum images (new posts store a content-hashed file, old ones a BLOB)
 UPLOAD_FOLDER = "static/uploads"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10 MB
 
+# File offload: Flask checks access and resolves the path, the front proxy sends the bytes.
+#   FILE_OFFLOAD=x-sendfile  Apache mod_xsendfile / lighttpd (absolute path in X-Sendfile)
+#   FILE_OFFLOAD=x-accel     nginx; X_ACCEL_LOCATIONS maps disk roots to internal locations,
+#                            e.g. "/srv/mfa/static=/_files/static,/srv/mfa/cache=/_files/cache"
+FILE_OFFLOAD = os.getenv("FILE_OFFLOAD", "").lower()
+X_ACCEL_LOCATIONS = [
+    (os.path.abspath(root), prefix.rstrip("/") + "/")
+    for root, _, prefix in (
+        item.partition("=") for item in os.getenv("X_ACCEL_LOCATIONS", "").split(",") if "=" in item
+    )
+]
+app.use_x_sendfile = FILE_OFFLOAD == "x-sendfile"  # send_file then only emits the header
+
+def send_path(fs_path, mimetype=None):
+    """send_file for a file on disk, handed to nginx with X-Accel-Redirect when it lives under a mapped root."""
+    if FILE_OFFLOAD == "x-accel":
+        full = os.path.abspath(fs_path)
+        for root, prefix in X_ACCEL_LOCATIONS:
+            if full.startswith(root + os.sep):
+                rel = os.path.relpath(full, root).replace(os.sep, "/")
+                resp = Response(mimetype=mimetype or mimetypes.guess_type(full)[0] or "application/octet-stream")
+                resp.headers["X-Accel-Redirect"] = prefix + urllib.parse.quote(rel)
+                return resp
+    return send_file(fs_path, mimetype=mimetype, conditional=True)
+
 
 # DB Pool
 def parse_db_url():
@@ -57,7 +105,9 @@ def parse_db_url():
         'port': p.port or 3306,
         'database': (p.path or '/mangaforall').lstrip('/'),
         'charset': 'utf8mb4',
-        'autocommit': False
+        'autocommit': False,
+        # also the socket timeout, so a stalled server raises instead of hanging the worker
+        'connection_timeout': int(os.getenv('DB_TIMEOUT', '5')),
     }
 DB_CFG = parse_db_url()
 POOL = pooling.MySQLConnectionPool(pool_name="mfa_pool", pool_size=5, **DB_CFG)
@@ -65,6 +115,66 @@ POOL = pooling.MySQLConnectionPool(pool_name="mfa_pool", pool_size=5, **DB_CFG)
 def get_conn():
     return POOL.get_connection()
 
+# Circuit breaker: after DB_BREAKER_FAILURES consecutive connection errors/timeouts (or an exhausted pool)
+# the DB is left alone for DB_BREAKER_COOLDOWN seconds; calls fail at once with DatabaseUnavailable and
+# cacheable pages are answered from their last cached copy. Then one trial call decides whether it closes.
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+DB_BREAKER_COOLDOWN = float(os.getenv("DB_BREAKER_COOLDOWN", "15"))
+DB_FAILURES = (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError,
+               mysql.connector.errors.PoolError)
+
+class DatabaseUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.cooldown:
+                self.state = "half-open"  # let exactly this call through as the trial
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive = 0
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.state == "half-open" or self.consecutive >= self.failures:
+                if self.state != "open":
+                    app.logger.error("Database circuit opened after %d failures", self.consecutive)
+                self.state = "open"
+                self.opened_at = time.time()
+
+db_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_COOLDOWN)
+
+@contextmanager
+def db_guard():
+    if not db_breaker.allow():
+        raise DatabaseUnavailable("database circuit is open")
+    try:
+        yield
+    except DB_FAILURES as e:
+        db_breaker.failure()
+        raise DatabaseUnavailable(str(e)) from e
+    except BaseException:
+        db_breaker.success()  # the server answered, even if it was to refuse the query
+        raise
+    else:
+        db_breaker.success()
+
 def query_all(query, args=()):
     conn = POOL.get_connection()
     cur = conn.cursor(dictionary=True)   # <-- important
@@ -74,21 +184,42 @@ def query_all(query, args=()):
     conn.close()
     return rows
 
-def query_all(sql, params=()):
-    with get_conn() as cnx:
+def query_all(sql, params=(), cache_tables=None, ttl=None):
+    """
+    Rows as dicts. Passing cache_tables (the tables whose changes should refresh the result) opts the
+    query into query_cache: the key holds those tables' versions, which execute() bumps on writes.
+    """
+    versions = [tag_version("table:" + t) for t in cache_tables or ()]
+    if versions and None not in versions:
+        key = "q:" + hashlib.sha1(f"{sql}\0{params!r}".encode("utf-8")).hexdigest() + "|" + \
+              ",".join(map(str, versions))
+        rows = query_cache.get(key)
+        if rows is None:
+            rows = query_all(sql, params)
+            query_cache.set(key, rows, ttl or QUERY_CACHE_TTL)
+        return [dict(r) for r in rows]  # callers may modify what they get back
+    with db_guard(), get_conn() as cnx:
         with cnx.cursor(dictionary=True) as cur:
             cur.execute(sql, params)
             return cur.fetchall()
 
-def query_one(sql, params=()):
-    rows = query_all(sql, params)
+def query_one(sql, params=(), cache_tables=None, ttl=None):
+    rows = query_all(sql, params, cache_tables, ttl)
     return rows[0] if rows else None
 
+_WRITE_TABLE_RE = re.compile(r"^\s*(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)", re.I)
+
+def invalidate_tables(*tables):
+    invalidate(*("table:" + t.lower() for t in tables))
+
 def execute(sql, params=()):
-    with get_conn() as cnx:
+    with db_guard(), get_conn() as cnx:
         with cnx.cursor() as cur:
             cur.execute(sql, params)
             cnx.commit()
+            m = _WRITE_TABLE_RE.match(sql)
+            if m:
+                invalidate_tables(m.group(1))
             return cur.lastrowid
 
 def resources_root():
@@ -138,6 +269,26 @@ def list_dir_sorted(path):
         return []
     return sorted(items, key=natural_sort_key)
 
+@functools.lru_cache(maxsize=256)
+def _chapters_for(manga_dir, dir_mtime):
+    chapters = set()
+    for d in os.listdir(manga_dir):
+        path = os.path.join(manga_dir, d)
+        if os.path.isdir(path) and is_chapter_folder(d):
+            chapters.add(d)
+        elif is_archive_name(d) and is_chapter_folder(d) and os.path.isfile(path):
+            chapters.add(os.path.splitext(d)[0])  # ch12.cbz is chapter "ch12"
+        elif d.lower().endswith(PACK_EXT) and is_chapter_folder(d):
+            chapters.add(d[:-len(PACK_EXT)])
+    return tuple(sorted(chapters, key=chapter_sort_key))
+
+def list_chapters(manga_dir):
+    """Chapters (folders, packs or .cbz/.zip) of a manga in reading order; re-listed only when the directory changes."""
+    try:
+        return _chapters_for(manga_dir, os.path.getmtime(manga_dir))
+    except FileNotFoundError:
+        return ()
+
 def list_images(folder_path):
     imgs = []
     try:
@@ -251,6 +402,1028 @@ def moderator_required(fn):
         return fn(*a, **k)
     return wrapper
 
+# Static assets (fingerprinted) #
+
+# flask assets build writes static/dist/<name>.<hash>.<ext> (+ .gz/.br) and a manifest mapping source names to them
+ASSET_SOURCES = ("style.css", "ui.js")
+ASSET_DIST = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST = os.path.join(ASSET_DIST, "manifest.json")
+
+@functools.lru_cache(maxsize=4)
+def _asset_manifest(mtime):
+    with open(ASSET_MANIFEST, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def asset_url(name):
+    """Hashed URL for a built asset; the plain static URL when the build hasn't been run (dev)."""
+    try:
+        built = _asset_manifest(os.path.getmtime(ASSET_MANIFEST)).get(name)
+    except (OSError, ValueError):
+        built = None
+    if not built:
+        return url_for("static", filename=name)
+    return url_for("asset", filename=built)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    path = safe_join(ASSET_DIST, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0]
+    encoding = None
+    for enc, ext in (("br", ".br"), ("gzip", ".gz")):
+        if _accepts_encoding(enc) and os.path.isfile(path + ext):
+            path, encoding = path + ext, enc
+            break
+    resp = send_path(path, mimetype=mimetype)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    # the name changes whenever the content does
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+def _accepts_encoding(enc):
+    return any(value == enc and q > 0 for value, q in request.accept_encodings)
+
+assets_cli = AppGroup("assets", help="Build the fingerprinted static assets.")
+app.cli.add_command(assets_cli)
+
+@assets_cli.command("build")
+def assets_build():
+    """Minify style.css and ui.js, fingerprint their names and write .gz/.br copies."""
+    import rcssmin
+    import rjsmin
+
+    os.makedirs(ASSET_DIST, exist_ok=True)
+    manifest = {}
+    for name in ASSET_SOURCES:
+        with open(os.path.join(app.static_folder, name), "r", encoding="utf-8") as f:
+            src = f.read()
+        out = (rcssmin.cssmin(src) if name.endswith(".css") else rjsmin.jsmin(src)).encode("utf-8")
+        stem, ext = os.path.splitext(name)
+        built = f"{stem}.{hashlib.sha256(out).hexdigest()[:10]}{ext}"
+        dst = os.path.join(ASSET_DIST, built)
+        with open(dst, "wb") as f:
+            f.write(out)
+        with open(dst + ".gz", "wb") as f:
+            f.write(gzip.compress(out, 9, mtime=0))
+        with open(dst + ".br", "wb") as f:
+            f.write(brotli.compress(out, quality=11))
+        manifest[name] = built
+        click.echo(f"{name} -> dist/{built}: {len(src.encode('utf-8'))} -> {len(out)} bytes, "
+                   f"gzip {os.path.getsize(dst + '.gz')}, br {os.path.getsize(dst + '.br')}")
+
+    # older builds stay for clients still holding last deploy's HTML; only the manifest moves
+    tmp = ASSET_MANIFEST + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, ASSET_MANIFEST)
+
+# Response compression #
+
+# HTML/JSON (and other text) responses are gzip/brotli-encoded on the fly; files and byte ranges are left alone
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))  # 4-5 is near gzip -6 in CPU, smaller output
+COMPRESS_MIMETYPES = {
+    "text/html", "text/plain", "text/css", "text/javascript", "application/javascript",
+    "application/json", "image/svg+xml",
+}
+
+def _compressor(encoding):
+    """(compress, finish, sync_flush) callables for one response body."""
+    if encoding == "br":
+        c = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return c.process, c.finish, c.flush
+    c = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    return c.compress, c.flush, lambda: c.flush(zlib.Z_SYNC_FLUSH)
+
+def compress_bytes(data, encoding):
+    compress, finish, _ = _compressor(encoding)
+    return compress(data) + finish()
+
+def precompress(data, mimetype):
+    """{encoding: bytes} for a body that will be served many times (page cache), {} if not worth it."""
+    if mimetype not in COMPRESS_MIMETYPES or len(data) < COMPRESS_MIN_BYTES:
+        return {}
+    return {e: compress_bytes(data, e) for e in ("br", "gzip")}
+
+def _best_encoding(available=("br", "gzip")):
+    return next((e for e in ("br", "gzip") if e in available and _accepts_encoding(e)), None)
+
+def _mark_encoded(resp, encoding):
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)  # same entity, different bytes
+
+def _compress_stream(chunks, encoding):
+    compress, finish, sync = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = compress(chunk) + sync()  # flush each template chunk so streaming still streams
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def compress_response(resp):
+    if resp.mimetype not in COMPRESS_MIMETYPES:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (resp.direct_passthrough or resp.status_code != 200 or "Content-Encoding" in resp.headers
+            or "no-transform" in (resp.headers.get("Cache-Control") or "")):
+        return resp
+    encoding = _best_encoding()
+    if not encoding:
+        return resp
+
+    if resp.is_streamed:
+        resp.response = _compress_stream(resp.response, encoding)
+        resp.headers.pop("Content-Length", None)
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        resp.set_data(compress_bytes(data, encoding))
+    _mark_encoded(resp, encoding)
+    return resp
+
+@app.cli.command("compress-bench")
+@click.option("--path", "paths", multiple=True, help="Page to render (repeatable). Defaults to /, /manga and /forum.")
+@click.option("--runs", default=20, show_default=True, type=int)
+def compress_bench(paths, runs):
+    """Render pages and report bytes saved against CPU time per gzip level / brotli quality."""
+    codecs = [("gzip", lvl, lambda d, lvl=lvl: gzip.compress(d, lvl)) for lvl in (1, 6, 9)]
+    codecs += [("br", q, lambda d, q=q: brotli.compress(d, quality=q)) for q in (1, 4, 6, 11)]
+    client = app.test_client()
+    for path in paths or ("/", "/manga", "/forum"):
+        data = client.get(path, headers={"Accept-Encoding": "identity"}).get_data()
+        click.echo(f"{path}: {len(data)} bytes")
+        for name, level, fn in codecs:
+            start = time.perf_counter()
+            for _ in range(runs):
+                out = fn(data)
+            ms = (time.perf_counter() - start) * 1000 / runs
+            saved = 100 * (1 - len(out) / len(data)) if data else 0
+            click.echo(f"  {name:>4} {level:>2}: {len(out):>8} bytes  {saved:5.1f}% saved  {ms:7.2f} ms")
+
+# Cache layer #
+
+# two tiers: a per-process LRU (LocalCache) in front of a shared backend every worker sees, picked by CACHE_URL:
+#   memory://                    process-local stand-in (default; also what tests can use)
+#   file:///var/cache/mfa        pickled entries in a directory shared by the workers on one host
+#   redis://[:password@]host:6379/0   any server speaking the Redis protocol
+# Tag versions ("catalog", "manga:<id>", "post:<id>", "table:<name>") live in the shared tier and are part
+# of every cache key, so bumping one with invalidate() makes the old entries unreachable. Each write also
+# bumps a generation counter; workers compare it once per request and drop their memoised versions.
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+CACHE_TIMEOUT = float(os.getenv("CACHE_TIMEOUT", "0.25"))  # seconds; a slow shared tier counts as a miss
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "5000"))
+FRAGMENT_CACHE_TTL = 600
+
+class CacheError(Exception):
+    pass
+
+class CacheUnavailable(CacheError):
+    """Raised without touching the network while a backend that just failed is being left alone."""
+
+def _cache_warning(e, msg, *args):
+    # the backend logs the start and end of an outage; don't repeat it for every call in between
+    if not isinstance(e, CacheUnavailable):
+        app.logger.warning(msg, *args)
+
+class LocalCache:
+    """Size-bounded LRU; entries expire after their TTL. Thread-safe."""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] < time.time():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+class CacheBackend:
+    """Shared tier. Values are bytes; counters are integers kept under their own keys."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """Set only if the key is absent; True if this call stored it."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key):
+        raise NotImplementedError
+
+    def get_int(self, key):
+        raw = self.get(key)
+        return int(raw) if raw is not None else 0
+
+class MemoryBackend(CacheBackend):
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] < time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key)
+            return item[0] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(key):
+                return False
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            item = self._live(key)
+            n = int(item[0]) + 1 if item else 1
+            self._data[key] = (str(n).encode(), None)
+            return n
+
+_FILE_ENTRY = struct.Struct("<d")  # expiry (0 = never), then the value
+CACHE_FILE_SWEEP = int(os.getenv("CACHE_FILE_SWEEP", "300"))  # seconds between sweeps of expired files
+
+class FileBackend(CacheBackend):
+    """One file per key under root; writes are atomic renames, counters are updated under flock (POSIX).
+    Keys embed tag versions, so invalidated entries are never read again: expired files are removed when
+    read and by a periodic sweep (one worker at a time) that keeps the directory from growing without bound."""
+
+    def __init__(self, root):
+        import fcntl  # noqa: F401 - fail at startup, not on the first invalidate
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._next_sweep = 0
+
+    def _path(self, key):
+        h = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, h[:2], h)
+
+    def _read(self, path, body=True):
+        try:
+            with open(path, "rb") as f:
+                (expires,) = _FILE_ENTRY.unpack(f.read(_FILE_ENTRY.size))
+                if not expires or expires >= time.time():
+                    return f.read() if body else b""
+        except FileNotFoundError:
+            return None
+        except struct.error:
+            pass
+        # expired or truncated; racing a writer that just replaced it only costs that entry a miss
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def sweep(self):
+        """Remove expired/unreadable entries and abandoned temp files. Returns how many were removed."""
+        import fcntl
+        removed = 0
+        with open(os.path.join(self.root, ".sweep.lock"), "a+b") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0  # another worker is sweeping
+            now = time.time()
+            for dirpath, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    if name.endswith(".lock"):
+                        continue
+                    if name.endswith(".tmp"):
+                        try:
+                            if os.path.getmtime(path) < now - 3600:
+                                os.remove(path)
+                                removed += 1
+                        except OSError:
+                            pass
+                    elif self._read(path, body=False) is None:
+                        removed += 1
+        return removed
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + CACHE_FILE_SWEEP
+
+        def run():
+            try:
+                n = self.sweep()
+                if n:
+                    app.logger.info("File cache sweep removed %d entries from %s", n, self.root)
+            except Exception:
+                app.logger.exception("File cache sweep of %s failed", self.root)
+        threading.Thread(target=run, daemon=True, name="cache-sweep").start()
+
+    def _write(self, path, value, ttl):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_FILE_ENTRY.pack(time.time() + ttl if ttl else 0))
+            f.write(value)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def set(self, key, value, ttl=None):
+        self._write(self._path(key), value, ttl)
+        self._maybe_sweep()
+
+    def add(self, key, value, ttl=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if self._read(path) is not None:
+                    return False
+                try:
+                    os.remove(path)  # expired: take it over
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "wb") as f:
+                f.write(_FILE_ENTRY.pack(time.time() + ttl if ttl else 0))
+                f.write(value)
+            return True
+        return False
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def incr(self, key):
+        import fcntl
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "a+b") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            raw = self._read(path)
+            n = int(raw) + 1 if raw else 1
+            self._write(path, str(n).encode(), None)
+            return n
+
+CACHE_RETRY = float(os.getenv("CACHE_RETRY", "5"))  # seconds to skip an unreachable Redis before retrying
+
+class RedisBackend(CacheBackend):
+    """Minimal Redis-protocol (RESP2) client: one connection per thread, no extra dependency.
+    After a connection failure every call fails fast with CacheUnavailable for CACHE_RETRY seconds,
+    so an outage costs one timeout per retry window instead of one per cache lookup."""
+
+    def __init__(self, host, port=6379, db=0, password=None):
+        self.addr = (host, port)
+        self.db = db
+        self.password = password
+        self._local = threading.local()
+        self._down_until = 0
+        self._down_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr, timeout=CACHE_TIMEOUT)
+        self._local.sock, self._local.rfile = sock, sock.makefile("rb")
+        if self.password:
+            self._call(b"AUTH", self.password)
+        if self.db:
+            self._call(b"SELECT", str(self.db))
+
+    def _reply(self):
+        line = self._local.rfile.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise CacheError(rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else self._local.rfile.read(n + 2)[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._reply() for _ in range(n)]
+        raise CacheError(f"unexpected reply {line[:20]!r}")
+
+    def _call(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(a), a))
+        self._local.sock.sendall(b"".join(parts))
+        return self._reply()
+
+    def command(self, *args):
+        if self._down_until and time.time() < self._down_until:
+            raise CacheUnavailable(f"{self.addr[0]}:{self.addr[1]} unreachable")
+        try:
+            if getattr(self._local, "sock", None) is None:
+                self._connect()
+            reply = self._call(*args)
+        except (OSError, CacheError) as e:
+            sock = getattr(self._local, "sock", None)
+            self._local.sock = None
+            if sock is not None:
+                sock.close()
+            if isinstance(e, OSError):
+                self._mark_down(e)
+            raise
+        if self._down_until:
+            with self._down_lock:
+                if self._down_until:
+                    self._down_until = 0
+                    app.logger.warning("Shared cache %s:%d reachable again", *self.addr)
+        return reply
+
+    def _mark_down(self, e):
+        with self._down_lock:
+            if not self._down_until:
+                app.logger.error("Shared cache %s:%d unreachable (%s); skipping it for %gs between retries",
+                                 self.addr[0], self.addr[1], e, CACHE_RETRY)
+            self._down_until = time.time() + CACHE_RETRY
+
+    def get(self, key):
+        return self.command(b"GET", key)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.command(b"SET", key, value, b"PX", int(ttl * 1000))
+        else:
+            self.command(b"SET", key, value)
+
+    def add(self, key, value, ttl=None):
+        args = (b"PX", int(ttl * 1000)) if ttl else ()
+        return self.command(b"SET", key, value, b"NX", *args) is not None
+
+    def delete(self, key):
+        self.command(b"DEL", key)
+
+    def incr(self, key):
+        return self.command(b"INCR", key)
+
+def cache_backend_from_url(url):
+    p = urllib.parse.urlparse(url)
+    if p.scheme == "memory":
+        return MemoryBackend()
+    if p.scheme == "file":
+        return FileBackend(p.path)
+    if p.scheme == "redis":
+        db = int((p.path or "/0").lstrip("/") or 0)
+        return RedisBackend(p.hostname or "127.0.0.1", p.port or 6379, db,
+                            urllib.parse.unquote(p.password) if p.password else None)
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
+
+shared_cache = cache_backend_from_url(CACHE_URL)
+
+class TieredCache:
+    """LocalCache in front of the shared backend; values are pickled on the way to the shared tier.
+    Shared-tier failures are logged and treated as misses, so a cache outage only costs speed."""
+
+    def __init__(self, local, shared, namespace):
+        self.local = local
+        self.shared = shared
+        self.namespace = namespace
+        self.shared_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            raw = self.shared.get(self.namespace + key)
+        except Exception as e:
+            self.shared_stats["errors"] += 1
+            _cache_warning(e, "Shared cache get failed: %s", e)
+            return default
+        if raw is None:
+            self.shared_stats["misses"] += 1
+            return default
+        self.shared_stats["hits"] += 1
+        value = pickle.loads(raw)
+        self.local.set(key, value, CACHE_LOCAL_TTL)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, min(ttl, CACHE_LOCAL_TTL) if ttl else CACHE_LOCAL_TTL)
+        try:
+            self.shared.set(self.namespace + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl)
+        except Exception as e:
+            self.shared_stats["errors"] += 1
+            _cache_warning(e, "Shared cache set failed: %s", e)
+
+    def delete(self, key):
+        self.local.delete(key)
+        try:
+            self.shared.delete(self.namespace + key)
+        except Exception as e:
+            _cache_warning(e, "Shared cache delete failed: %s", e)
+
+    @property
+    def stats(self):
+        return dict(self.local.stats, entries=len(self.local), shared=dict(self.shared_stats))
+
+# keys embed tag versions, so the local copy of an entry is never wrong, only possibly gone from the
+# shared tier; CACHE_LOCAL_TTL bounds how long a worker keeps one without asking the shared tier
+CACHE_LOCAL_TTL = int(os.getenv("CACHE_LOCAL_TTL", "300"))
+cache = TieredCache(LocalCache(CACHE_MAX_ITEMS), shared_cache, "c:")
+# results of query_all(..., cache_tables=...); kept apart so its hit/miss/eviction counts are its own
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "300"))
+query_cache = TieredCache(LocalCache(int(os.getenv("QUERY_CACHE_MAX_ITEMS", "2000"))), shared_cache, "q:")
+
+_tag_lock = threading.Lock()
+_tag_memo = {}           # tag -> version, valid until the generation moves
+_tag_generation = None
+
+def sync_cache_generation():
+    """Drop memoised tag versions if any worker has invalidated something since we last looked."""
+    global _tag_generation
+    try:
+        gen = shared_cache.get_int("gen")
+    except Exception as e:
+        _cache_warning(e, "Shared cache generation check failed: %s", e)
+        # other workers' invalidations can't be seen now, so no memoised version can be trusted either
+        with _tag_lock:
+            _tag_memo.clear()
+            _tag_generation = None
+        return
+    if gen != _tag_generation:
+        with _tag_lock:
+            _tag_memo.clear()
+            _tag_generation = gen
+
+def tag_version(tag):
+    """The tag's current version, or None when the shared tier can't tell: invalidate() can't bump
+    anything then, so callers must neither read nor store entries keyed on it."""
+    v = _tag_memo.get(tag)
+    if v is None:
+        try:
+            v = shared_cache.get_int("tag:" + tag)
+        except Exception as e:
+            _cache_warning(e, "Shared cache tag read failed: %s", e)
+            return None
+        with _tag_lock:
+            _tag_memo[tag] = v
+    return v
+
+def invalidate(*tags):
+    try:
+        for tag in tags:
+            shared_cache.incr("tag:" + tag)
+        shared_cache.incr("gen")
+    except Exception as e:
+        app.logger.error("Cache invalidation of %s failed: %s", tags, e)
+    with _tag_lock:
+        for tag in tags:
+            _tag_memo.pop(tag, None)
+
+@app.before_request
+def _sync_cache():
+    sync_cache_generation()
+
+def fragment_key(name, *tags):
+    """Cache key for a template fragment that changes whenever one of `tags` is invalidated
+    (None while a version is unknown: the block is then rendered without the cache)."""
+    versions = [tag_version(t) for t in tags]
+    if None in versions:
+        return None
+    return name + "|" + ",".join(f"{t}@{v}" for t, v in zip(tags, versions))
+
+class FragmentCacheExtension(Extension):
+    """{% cache key[, ttl] %}...{% endcache %}: the rendered block is kept in `cache` under key."""
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        args.append(parser.parse_expression() if parser.stream.skip_if("comma") else nodes.Const(FRAGMENT_CACHE_TTL))
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cached", args), [], [], body).set_lineno(lineno)
+
+    def _cached(self, key, ttl, caller):
+        if key is None:
+            return caller()
+        key = "frag:" + key
+        html = cache.get(key)
+        if html is None:
+            html = caller()
+            cache.set(key, html, ttl)
+        return html
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.globals["fragment_key"] = fragment_key
+
+# Single-flight #
+
+# when many callers miss the same key at once, one computes and the rest wait for its result:
+# threads of a worker wait on an Event, other workers wait on a lock key in the shared tier
+FLIGHT_WAIT = float(os.getenv("FLIGHT_WAIT", "10"))  # longest a follower waits before computing itself
+FLIGHT_LOCK_TTL = 30   # a crashed leader's lock lapses after this many seconds
+FLIGHT_POLL = 0.05
+
+_flight_lock = threading.Lock()
+_flights = {}  # key -> Event set when this worker's leader finishes
+flight_stats = {"leaders": 0, "followers": 0, "timeouts": 0}
+
+def _flight_count(name):
+    with _flight_lock:
+        flight_stats[name] += 1
+
+class Flight:
+    """Outcome of flight_begin: either `value` (someone else computed it) or the duty to compute and end()."""
+
+    def __init__(self, key, value=None, owns_local=False, owns_shared=False):
+        self.key = key
+        self.value = value
+        self.owns_local = owns_local
+        self.owns_shared = owns_shared
+
+    def end(self):
+        if self.owns_shared:
+            self.owns_shared = False
+            try:
+                shared_cache.delete("flight:" + self.key)
+            except Exception as e:
+                _cache_warning(e, "Releasing flight lock %s failed: %s", self.key, e)
+        if self.owns_local:
+            self.owns_local = False
+            with _flight_lock:
+                ev = _flights.pop(self.key, None)
+            if ev is not None:
+                ev.set()
+
+def _take_shared_flight(key):
+    try:
+        return shared_cache.add("flight:" + key, str(os.getpid()).encode(), FLIGHT_LOCK_TTL)
+    except Exception as e:
+        _cache_warning(e, "Flight lock %s unavailable: %s", key, e)
+        return True  # no shared tier: coalesce within this worker only
+
+def flight_begin(key, load):
+    """
+    Join the computation of `key`. load() returns the finished result or None.
+    Returns a Flight with .value set if another caller produced it while we waited; otherwise the
+    caller computes, stores the result where load() will find it, and calls flight.end().
+    """
+    deadline = time.time() + FLIGHT_WAIT
+    with _flight_lock:
+        ev = _flights.get(key)
+        if ev is None:
+            _flights[key] = threading.Event()
+    if ev is not None:
+        _flight_count("followers")
+        ev.wait(FLIGHT_WAIT)
+        value = load()
+        if value is not None:
+            return Flight(key, value)
+        _flight_count("timeouts")
+        return Flight(key)
+
+    flight = Flight(key, owns_local=True)
+    flight.owns_shared = _take_shared_flight(key)
+    while not flight.owns_shared and time.time() < deadline:
+        # another worker is computing it
+        time.sleep(FLIGHT_POLL)
+        value = load()
+        if value is not None:
+            flight.end()
+            _flight_count("followers")
+            return Flight(key, value)
+        flight.owns_shared = _take_shared_flight(key)
+    if not flight.owns_shared:
+        _flight_count("timeouts")
+    value = load()  # the previous holder may have finished just before we got the lock
+    if value is not None:
+        flight.end()
+        return Flight(key, value)
+    _flight_count("leaders")
+    return flight
+
+def cached_call(key, ttl, compute):
+    """compute() once per key across threads and workers, keeping the result in `cache` for ttl seconds."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    flight = flight_begin(key, lambda: cache.get(key))
+    if flight.value is not None:
+        return flight.value
+    try:
+        value = compute()
+        cache.set(key, value, ttl)
+        return value
+    finally:
+        flight.end()
+
+# Conditional GETs (entity ETags) #
+
+# Views build an ETag from the versions of what they show, check it before rendering and answer
+# 304 with no template work. RENDER_EPOCH folds in the deployed templates/assets so a deploy
+# never revalidates an old copy.
+def _render_epoch():
+    paths = glob.glob(os.path.join(app.root_path, "templates", "*.html")) + [__file__, ASSET_MANIFEST]
+    return max((os.path.getmtime(p) for p in paths if os.path.exists(p)), default=0)
+
+RENDER_EPOCH = _render_epoch()
+
+def entity_etag(*parts):
+    return hashlib.sha1(repr((RENDER_EPOCH,) + parts).encode()).hexdigest()[:24]
+
+def viewer_key():
+    """The parts of the current user a personalised page renders from."""
+    u = current_user()
+    if not u:
+        return None
+    return (u["user_id"], bool(is_admin(u)), bool(is_moderator(u)), bool(is_content_manager(u)),
+            session.get("avatar_ver", 0))
+
+def with_etag(resp, etag, private=False):
+    resp = make_response(resp)
+    if etag:
+        resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache" if private else "no-cache"
+    return resp
+
+def not_modified(etag, private=False):
+    """A bodiless 304 when the client already holds `etag`; None means render as usual."""
+    if (not etag or request.method not in ("GET", "HEAD") or "_flashes" in session
+            or not request.if_none_match.contains_weak(etag)):
+        return None
+    return with_etag(Response(status=304), etag, private)
+
+# Anonymous page cache #
+
+# whole responses for GETs of the shared catalog pages (the personal bits come from /me),
+# keyed on path + normalised query string.
+# Entries carry the versions of the tags they depend on, so invalidate() on a write path makes exactly
+# the affected entries miss. Past PAGE_CACHE_TTL an entry is still served for
+# PAGE_CACHE_STALE seconds while one background request regenerates it.
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", "60"))
+PAGE_CACHE_STALE = int(os.getenv("PAGE_CACHE_STALE", "600"))
+PAGE_CACHE_KEEP = int(os.getenv("PAGE_CACHE_KEEP", "86400"))  # last good copy, served while the DB is down
+PAGE_CACHE_TAGS = {
+    "index": ("catalog",),
+    "manga_list": ("catalog",),
+    "manga_detail": ("manga:{manga_id}",),
+    "forum": ("forum",),
+}
+
+_page_lock = threading.Lock()
+_page_refreshing = set()
+_page_stats = {"hit": 0, "stale": 0, "miss": 0, "degraded": 0}
+
+def _page_key():
+    args = sorted((k, v.strip()) for k, v in request.args.items(multi=True) if v.strip())
+    return request.path + ("?" + urllib.parse.urlencode(args) if args else "")
+
+def _page_cacheable():
+    return request.method == "GET" and request.endpoint in PAGE_CACHE_TAGS and "_flashes" not in session
+
+def _page_response(entry, state):
+    with _page_lock:
+        _page_stats[state.lower()] += 1
+    # the encoded bodies were made once when the entry was stored; compress_response skips these
+    encoding = _best_encoding(entry.get("encoded", ()))
+    resp = Response(entry["encoded"][encoding] if encoding else entry["body"], status=200,
+                    mimetype=entry["mimetype"])
+    if entry.get("etag"):
+        resp = with_etag(resp, entry["etag"])
+    if encoding:
+        _mark_encoded(resp, encoding)
+    resp.headers["X-Cache"] = state
+    return resp.make_conditional(request)
+
+def _load_page(key):
+    """The cached entry for key if it is still current (fresh or within the stale window)."""
+    entry = cache.get("page:" + key)
+    if entry is None or any(tag_version(t) != v for t, v in entry["tags"].items()):
+        return None
+    if time.time() - entry["stored"] > PAGE_CACHE_TTL + PAGE_CACHE_STALE:
+        return None
+    return entry
+
+def _refresh_page(key, lock):
+    try:
+        with app.test_request_context(key):
+            g.page_cache_refresh = True
+            app.full_dispatch_request()  # the after_request hook stores the fresh copy
+    except Exception as e:
+        app.logger.warning("Page cache refresh of %s failed: %s", key, e)
+    finally:
+        lock.end()
+        with _page_lock:
+            _page_refreshing.discard(key)
+
+@app.before_request
+def serve_cached_page():
+    if not _page_cacheable():
+        return None
+    key = _page_key()
+    tags = {t.format(**(request.view_args or {})) for t in PAGE_CACHE_TAGS[request.endpoint]}
+    # versions as of now: a write landing while this renders leaves the stored copy already stale
+    versions = {t: tag_version(t) for t in tags}
+    if None in versions.values():
+        return None  # shared tier down: render fresh, and don't store what can't be invalidated
+    g.page_cache = (key, versions)
+    if g.get("page_cache_refresh"):
+        return None
+    entry = _load_page(key)
+    if entry is None:
+        # concurrent misses wait for the one request that renders it
+        flight = flight_begin("page:" + key, lambda: _load_page(key))
+        if flight.value is not None:
+            return _page_response(flight.value, "HIT")
+        g.page_flight = flight
+        return None
+    if time.time() - entry["stored"] <= PAGE_CACHE_TTL:
+        return _page_response(entry, "HIT")
+    with _page_lock:
+        refresh = key not in _page_refreshing
+        _page_refreshing.add(key)
+    # one refresh per key across workers too
+    lock = Flight("refresh:" + key, owns_shared=refresh and _take_shared_flight("refresh:" + key))
+    if lock.owns_shared:
+        threading.Thread(target=_refresh_page, args=(key, lock), daemon=True).start()
+    elif refresh:
+        with _page_lock:
+            _page_refreshing.discard(key)
+    return _page_response(entry, "STALE")
+
+@app.after_request
+def store_cached_page(resp):
+    # registered after compress_response, so it runs first and sees the uncompressed body
+    pending = g.pop("page_cache", None)
+    if (pending is None or resp.status_code != 200 or resp.is_streamed
+            or "Set-Cookie" in resp.headers or "X-Cache" in resp.headers):
+        return resp
+    key, tags = pending
+    body = resp.get_data()
+    etag = resp.get_etag()[0]
+    if not etag:
+        etag = entity_etag(hashlib.sha1(body).hexdigest())
+        resp = with_etag(resp, etag)
+    # "body" stays uncompressed: the degraded-mode handler edits it
+    entry = {"body": body, "mimetype": resp.mimetype, "stored": time.time(), "tags": tags, "etag": etag,
+             "encoded": precompress(body, resp.mimetype)}
+    cache.set("page:" + key, entry, max(PAGE_CACHE_TTL + PAGE_CACHE_STALE, PAGE_CACHE_KEEP))
+    with _page_lock:
+        _page_stats["miss"] += 1
+    encoding = _best_encoding(entry["encoded"])
+    if encoding:
+        resp.set_data(entry["encoded"][encoding])
+        _mark_encoded(resp, encoding)
+    resp.headers["X-Cache"] = "MISS"
+    return resp.make_conditional(request)
+
+@app.teardown_request
+def end_page_flight(exc):
+    # after store_cached_page (or a failed render): wake the requests waiting on this page
+    flight = g.pop("page_flight", None)
+    if flight is not None:
+        flight.end()
+
+DEGRADED_BANNER = (b'<div class="container">\n    <div class="alert warn">We are having database trouble. '
+                   b'You are seeing a saved copy of this page; sign-in and posting are paused.</div>'
+                   b'\n    <div class="space"></div>')
+
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(e):
+    app.logger.warning("Database unavailable for %s %s: %s", request.method, request.path, e)
+    if request.method == "GET" and request.endpoint in PAGE_CACHE_TAGS:
+        # any copy will do, however old or invalidated: it beats an error page
+        entry = cache.get("page:" + _page_key())
+        if entry is not None:
+            with _page_lock:
+                _page_stats["degraded"] += 1
+            body = entry["body"].replace(b'<div class="container">', DEGRADED_BANNER, 1)
+            resp = Response(body, status=200, mimetype=entry["mimetype"])
+            resp.headers["X-Cache"] = "DEGRADED"
+            resp.headers["Cache-Control"] = "no-store"
+            return resp
+    if request.path.startswith("/api/") or request.accept_mimetypes.best == "application/json":
+        resp = make_response({"error": "database unavailable"}, 503)
+    else:
+        resp = Response("<!doctype html><title>Temporarily unavailable</title>"
+                        "<p>The database is temporarily unavailable and nothing was changed. "
+                        "Please try again in a moment.</p>", status=503, mimetype="text/html")
+    resp.headers["Retry-After"] = str(int(DB_BREAKER_COOLDOWN))
+    return resp
+
+@app.get('/admin/cache-stats')
+@admin_required
+def cache_stats():
+    with _page_lock:
+        served = sum(_page_stats.values())
+        pages = dict(_page_stats,
+                     hit_ratio=round((_page_stats["hit"] + _page_stats["stale"]) / served, 4) if served else None)
+    return {
+        "pages": pages,
+        "cache": cache.stats,
+        "queries": query_cache.stats,
+        "single_flight": dict(flight_stats),
+        "database": {"circuit": db_breaker.state, "consecutive_failures": db_breaker.consecutive},
+    }
+
+@app.cli.command("herd-bench")
+@click.option("--path", default="/manga", show_default=True, help="Cached page to hit.")
+@click.option("--clients", default=50, show_default=True, type=int)
+@click.option("--rounds", default=3, show_default=True, type=int)
+def herd_bench(path, clients, rounds):
+    """Hit a just-expired page from many threads at once and count how many requests actually rendered it."""
+    renders = []
+    def count(sender, template, context, **extra):
+        renders.append(template.name)
+    template_rendered.connect(count, app)
+    try:
+        for r in range(rounds):
+            cache.delete("page:" + path)
+            renders.clear()
+            before = dict(flight_stats)
+            barrier = threading.Barrier(clients)
+            results = []
+
+            def hit():
+                client = app.test_client()
+                barrier.wait()
+                resp = client.get(path)
+                results.append((resp.status_code, resp.headers.get("X-Cache")))
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=hit) for _ in range(clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            ms = (time.perf_counter() - start) * 1000
+            delta = {k: flight_stats[k] - before[k] for k in flight_stats}
+            states = {}
+            for status, state in results:
+                states[f"{status} {state}"] = states.get(f"{status} {state}", 0) + 1
+            click.echo(f"round {r + 1}: {clients} requests, {len(renders)} renders, {ms:.0f} ms, {states}, {delta}")
+    finally:
+        template_rendered.disconnect(count, app)
+
 @app.context_processor
 def inject_everything():
     # one place to inject current_user everywhere
@@ -261,8 +1434,36 @@ def inject_everything():
         is_moderator=is_moderator,
         user_is_banned=user_is_banned,
         user_id_is_banned=user_id_is_banned,
+        resource_url=resource_url,
+        asset_url=asset_url,
     )
 
+@app.get('/me')
+def me():
+    """Per-user state for shared (cacheable) pages; ui.js fills the page's data-me-* hooks from it.
+    `?manga=<id>&folder=<name>` adds the favourite flag and resume point for a detail page."""
+    u = current_user()
+    data = {"user": None}
+    if u:
+        data["user"] = {
+            "id": u["user_id"],
+            "username": u["username"],
+            "avatar": url_for("user_avatar", uid=u["user_id"], s=48),
+            "content_manager": bool(is_content_manager(u)),
+            "moderator": bool(is_moderator(u)),
+            "admin": bool(is_admin(u)),
+        }
+        manga_id = request.args.get("manga", type=int)
+        if manga_id:
+            data["favorited"] = is_favorited(u["user_id"], manga_id)
+        folder = request.args.get("folder")
+        p = user_progress(u["user_id"]).get(folder) if folder else None
+        if p:
+            data["resume"] = dict(p, url=url_for("reader", folder=folder, chapter=p["chapter"]) + f"#p={p['page'] + 1}")
+    resp = make_response(data)
+    resp.headers["Cache-Control"] = "private, no-store"
+    return resp
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -277,7 +1478,7 @@ def register():
             flash('User already exists.', 'danger')
             return render_template('register.html')
 
-        with get_conn() as cnx:
+        with db_guard(), get_conn() as cnx:
             cur = cnx.cursor()
             try:
                 cur.execute(
@@ -293,6 +1494,7 @@ def register():
                 cnx.commit()
             finally:
                 cur.close()
+        invalidate_tables("users", "user_auth")
         flash('Registered. Please log in.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -330,18 +1532,22 @@ def logout():
 # --------------------------- 
 @app.route('/')
 def index():
-    mangas = query_all("""
-        SELECT manga_id, Title, Author_name, synopsis, publication_status, CoverPath
+    return render_template('index.html', mangas=catalog_rows(), shared_page=True)
+
+def catalog_rows():
+    return query_all("""
+        SELECT manga_id, Title, Author_name, synopsis, publication_status, CoverPath,
+               ThumbPath, CoverColor
         FROM manga
         ORDER BY manga_id DESC
-    """)
-    return render_template('index.html', mangas=mangas, user=current_user())
+    """, cache_tables=("manga",))
 
 @app.route('/manga', methods=['GET'])
 def manga_list():
     q = (request.args.get('q') or '').strip()
     base_sql = """
-        SELECT manga_id, Title, Author_name, synopsis, publication_status, CoverPath
+        SELECT manga_id, Title, Author_name, synopsis, publication_status, CoverPath,
+               ThumbPath, CoverColor
         FROM manga
     """
     params = ()
@@ -356,38 +1562,69 @@ def manga_list():
         params = (like, like, like)
     else:
         sql = base_sql + " ORDER BY Title ASC"
-    mangas = query_all(sql, params)
-    return render_template('manga.html', mangas=mangas, q=q, user=current_user())
-
-@app.route('/manga/<int:manga_id>')
-def manga_detail(manga_id):
-    m = query_one("SELECT * FROM manga WHERE manga_id=%s", (manga_id,))
-    if not m:
-        abort(404)
+    mangas = query_all(sql, params, cache_tables=("manga",))
+    return render_template('manga.html', mangas=mangas, q=q, shared_page=True)
 
+def _manga_folder(m):
+    """Infer a title's folder under Resources/ from its CoverPath or Title."""
     db_title  = (m.get('Title') or '').strip()
-    db_author = (m.get('Author_name') or '').strip()
     coverpath = (m.get('CoverPath') or '').strip()
-
-    # infer folder from CoverPath or Title
-    folder = None
     if coverpath.startswith("Resources/"):
         parts = coverpath.split("/")
         if len(parts) >= 2 and parts[1]:
-            folder = parts[1]
-    if not folder and db_title:
+            return parts[1]
+    if db_title:
         base = resources_root()
         if os.path.isdir(base):
             for d in os.listdir(base):
                 if os.path.isdir(os.path.join(base, d)) and d.lower() == db_title.lower():
-                    folder = d
-                    break
+                    return d
+    return None
+
+def _review_stats(manga_id):
+    return query_one("""
+        SELECT COALESCE(AVG(ratings),0) AS avg_rating,
+               COUNT(*)                 AS review_count,
+               MAX(created_at)          AS latest_review
+        FROM review_rating
+        WHERE manga_id=%s
+    """, (manga_id,), cache_tables=("review_rating",))
+
+def _manga_etag(m, folder):
+    """Row + review stats + the mtimes of the files the detail page reads. Only stored data goes in
+    (no tag versions), so it means the same in every worker and in flask export-static.
+    A review edit resets its created_at, so latest_review moves even when count and average don't."""
+    stats = _review_stats(m["manga_id"])
+    mtimes = ()
+    if folder:
+        fpath = os.path.join(resources_root(), folder)
+        mtimes = tuple(os.path.getmtime(p) if os.path.exists(p) else 0 for p in (
+            fpath, os.path.join(fpath, "manga.txt"), os.path.join(fpath, "synopsis.txt"),
+            os.path.join(fpath, "Cover.jpg")))
+    return entity_etag("manga", sorted(m.items()), stats["review_count"], stats["avg_rating"],
+                       stats["latest_review"], folder, mtimes)
+
+@app.route('/manga/<int:manga_id>')
+def manga_detail(manga_id):
+    m = query_one("SELECT * FROM manga WHERE manga_id=%s", (manga_id,), cache_tables=("manga",))
+    if not m:
+        abort(404)
+
+    folder = _manga_folder(m)
+    etag = _manga_etag(m, folder)
+    # a page-cache miss that owns the render must store it, so only answer 304 outside one
+    if "page_flight" not in g:
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+
+    db_title  = (m.get('Title') or '').strip()
+    db_author = (m.get('Author_name') or '').strip()
+    coverpath = (m.get('CoverPath') or '').strip()
 
     base = resources_root()
     meta = {"Author_name": "", "publication_status": "", "Title": ""}
     synopsis_text = (m.get("synopsis") or "").strip()
-    u=current_user()
-    favorited = is_favorited(u["user_id"], manga_id) if u else False
     if folder:
         fpath = os.path.join(base, folder)
         meta = parse_manga_txt(os.path.join(fpath, "manga.txt")) or meta
@@ -404,19 +1641,15 @@ def manga_detail(manga_id):
     if folder:
         cover_fs = os.path.join(base, folder, "Cover.jpg")
         if os.path.isfile(cover_fs):
-            cover_url = f"/static/Resources/{folder}/Cover.jpg"
+            cover_url = resource_url(f"Resources/{folder}/Cover.jpg")
     if not cover_url and coverpath:
-        cover_url = f"/static/{coverpath}"
+        cover_url = resource_url(coverpath)
 
     chapters = []
     if folder:
         fpath = os.path.join(base, folder)
         if os.path.isdir(fpath):
-            chapters = [
-                d for d in os.listdir(fpath)
-                if os.path.isdir(os.path.join(fpath, d)) and is_chapter_folder(d)
-            ]
-            chapters.sort(key=chapter_sort_key)
+            chapters = list(list_chapters(fpath))
 
     manga_ctx = dict(m)
     manga_ctx["Title"] = title_final
@@ -434,28 +1667,107 @@ def manga_detail(manga_id):
         JOIN users u ON u.user_id = rr.user_id
         WHERE rr.manga_id=%s
         ORDER BY rr.created_at DESC
-    """, (manga_id,))
+    """, (manga_id,), cache_tables=("review_rating",))
 
-    avg_row = query_one("""
-        SELECT COALESCE(AVG(ratings),0) AS avg_rating,
-               COUNT(*)                 AS review_count
-        FROM review_rating
-        WHERE manga_id=%s
-    """, (manga_id,))
+    avg_row = _review_stats(manga_id)
 
-    return render_template(
+    return with_etag(render_template(
         "manga_detail.html",
         manga=manga_ctx,
         folder=folder,
         cover_url=cover_url,
         chapters=chapters,
         meta=meta,
-        favorited=favorited,
         reviews=reviews,
         avg_rating=float(avg_row["avg_rating"] or 0),
         review_count=int(avg_row["review_count"] or 0),
-        user=current_user()
-    )
+        shared_page=True,
+    ), etag)
+# Static export #
+
+# flask export-static writes the anonymous catalog pages as plain files (+ .gz/.br) for a CDN or web server:
+# / -> index.html, /manga -> manga.html, /manga/<id> -> manga/<id>.html. The export keeps each page's
+# ETag in a manifest, so the next run re-renders only pages whose inputs changed and drops removed titles.
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(app.root_path, "export"))
+EXPORT_MANIFEST = ".export-manifest.json"
+EXPORT_SUFFIXES = ("", ".gz", ".br")
+
+def _export_file(out, path):
+    return os.path.join(out, "index.html" if path == "/" else path.lstrip("/").replace("/", os.sep) + ".html")
+
+def _export_keys():
+    """{path: etag} for every exported page, computed from the same inputs as the views' ETags."""
+    catalog = entity_etag("catalog", catalog_rows())
+    keys = {"/": catalog, "/manga": catalog}
+    for m in query_all("SELECT * FROM manga", cache_tables=("manga",)):
+        keys[f"/manga/{m['manga_id']}"] = _manga_etag(m, _manga_folder(m))
+    return keys
+
+def _export_page(out, path):
+    """Render one page fresh (never a stale page-cache copy) and write it with .gz/.br siblings."""
+    with app.test_request_context(path):
+        g.page_cache_refresh = True
+        resp = app.full_dispatch_request()
+    if resp.status_code != 200 or resp.headers.get("X-Cache") == "DEGRADED":
+        raise RuntimeError(f"HTTP {resp.status_code} {resp.headers.get('X-Cache') or ''}".strip())
+    body = resp.get_data()
+    dst = _export_file(out, path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    for suffix, data in zip(EXPORT_SUFFIXES, (body, gzip.compress(body, 9, mtime=0),
+                                              brotli.compress(body, quality=11))):
+        tmp = dst + suffix + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst + suffix)
+    return len(body)
+
+@app.cli.command("export-static")
+@click.option("--out", default=EXPORT_DIR, show_default=True, help="Directory to write the pages to.")
+@click.option("--workers", default=os.cpu_count() or 2, show_default=True, type=int)
+@click.option("--full", is_flag=True, help="Re-render every page, ignoring the last export.")
+def export_static(out, workers, full):
+    """Render the anonymous catalog and detail pages to static files; re-runs only redo what changed."""
+    start = time.perf_counter()
+    manifest_path = os.path.join(out, EXPORT_MANIFEST)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+
+    keys = _export_keys()
+    todo = [p for p, k in keys.items() if full or previous.get(p) != k]
+    manifest = {p: k for p, k in keys.items() if p not in todo}
+    os.makedirs(out, exist_ok=True)
+    written = failed = 0
+    # rendering is CPU-bound, so processes; spawned rather than forked so no worker shares the
+    # parent's pooled MySQL connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [(p, pool.submit(_export_page, out, p)) for p in todo]
+        for path, fut in futures:
+            try:
+                written += fut.result()
+                manifest[path] = keys[path]  # failed pages stay out of the manifest and are retried next run
+            except Exception as e:
+                failed += 1
+                click.echo(f"{path}: {e}")
+
+    removed = [p for p in previous if p not in keys]
+    for path in removed:
+        for suffix in EXPORT_SUFFIXES:
+            try:
+                os.remove(_export_file(out, path) + suffix)
+            except OSError:
+                pass
+
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_path)
+    ms = (time.perf_counter() - start) * 1000
+    click.echo(f"Rendered {len(todo) - failed} of {len(keys)} pages ({written} bytes), {failed} failed, "
+               f"{len(removed)} removed, in {ms:.0f} ms.")
+
 # Add-reviews/ratings #
 @app.post("/manga/<int:manga_id>/review")
 @login_required
@@ -482,6 +1794,7 @@ def add_review(manga_id):
             reviews = VALUES(reviews),
             created_at = CURRENT_TIMESTAMP
     """, (manga_id, u["user_id"], rating, body))
+    invalidate(f"manga:{manga_id}")
 
     return redirect(url_for("manga_detail", manga_id=manga_id))
 
@@ -490,7 +1803,8 @@ def add_review(manga_id):
 def profile():
     u = current_user()
     favorites = user_favorites(u["user_id"])
-    return render_template("profile.html", user=u, favorites=favorites)
+    return render_template("profile.html", user=u, favorites=favorites,
+                           shelf=continue_reading(u["user_id"]))
 
 
 # Resources scanning helpers
@@ -535,6 +1849,8 @@ def is_chapter_folder(name: str) -> bool:
     lname = name.lower()
     return lname.startswith("ch") or lname.startswith("chapter")
 
+SCAN_CACHE_TTL = 60
+
 def scan_resources_content():
     base = resources_root()
     items = []
@@ -550,12 +1866,8 @@ def scan_resources_content():
         title = meta.get("Title") or folder
         synopsis = read_synopsis(os.path.join(fpath, "synopsis.txt"))
         cover_fs = os.path.join(fpath, "Cover.jpg")
-        cover_url = f"/static/Resources/{folder}/Cover.jpg" if os.path.isfile(cover_fs) else None
-        ch_dirs = [
-            d for d in os.listdir(fpath)
-            if os.path.isdir(os.path.join(fpath, d)) and is_chapter_folder(d)
-        ]
-        ch_dirs.sort(key=chapter_sort_key)
+        cover_url = resource_url(f"Resources/{folder}/Cover.jpg") if os.path.isfile(cover_fs) else None
+        ch_dirs = list(list_chapters(fpath))
         items.append({
             "Title": title,
             "Author_name": meta.get("Author_name") or "Unknown",
@@ -572,7 +1884,14 @@ def scan_resources_content():
 @content_manager_required
 def content_dashboard():
     u = current_user()
-    mangas = scan_resources_content()
+    # several managers opening the dashboard at once share one walk of static/Resources
+    base = resources_root()
+    mtime = os.path.getmtime(base) if os.path.isdir(base) else 0
+    version = tag_version("resources")
+    if version is None:
+        mangas = scan_resources_content()
+    else:
+        mangas = cached_call(f"scan-resources@{mtime}|{version}", SCAN_CACHE_TTL, scan_resources_content)
     return render_template('dash_content.html', mangas=mangas, user=u)
 
 @app.route('/dashboard/content/<folder>')
@@ -589,13 +1908,9 @@ def content_detail(folder):
     title = meta.get("Title") or folder
     synopsis = read_synopsis(os.path.join(fpath, "synopsis.txt"))
     cover_fs = os.path.join(fpath, "Cover.jpg")
-    cover_url = f"/static/Resources/{folder}/Cover.jpg" if os.path.isfile(cover_fs) else None
+    cover_url = resource_url(f"Resources/{folder}/Cover.jpg") if os.path.isfile(cover_fs) else None
 
-    chapters = [
-        d for d in os.listdir(fpath)
-        if os.path.isdir(os.path.join(fpath, d)) and is_chapter_folder(d)
-    ]
-    chapters.sort(key=chapter_sort_key)
+    chapters = list(list_chapters(fpath))
 
     existing = query_one("SELECT manga_id FROM manga WHERE Title=%s", (title,))
     approved = bool(existing)
@@ -611,6 +1926,57 @@ def content_detail(folder):
         chapters=chapters,
         approved=approved
     )
+# Cover thumbnails #
+
+# card-sized 2:3 WebP of each cover plus its dominant colour, both stored on the manga row
+COVER_THUMB_FOLDER = os.path.join(app.static_folder, "covers")
+COVER_THUMB_SIZE = (360, 540)
+
+def make_cover_thumb(cover_fs, key):
+    """Write the card thumbnail for a cover. Returns (ThumbPath, CoverColor) or (None, None)."""
+    try:
+        with Image.open(cover_fs) as img:
+            img = img.convert("RGB")
+            pal = img.resize((64, 64)).quantize(colors=5)
+            _, idx = max(pal.getcolors())
+            color = "#%02x%02x%02x" % tuple(pal.getpalette()[idx * 3: idx * 3 + 3])
+            thumb = ImageOps.fit(img, COVER_THUMB_SIZE, Image.LANCZOS)
+        stem = secure_filename(key) or "cover"
+        # mtime in the name so a replaced cover gets a fresh URL
+        name = f"{stem}_{int(os.path.getmtime(cover_fs))}.webp"
+        os.makedirs(COVER_THUMB_FOLDER, exist_ok=True)
+        tmp = os.path.join(COVER_THUMB_FOLDER, name + ".tmp")
+        thumb.save(tmp, "WEBP", quality=80)
+        os.replace(tmp, os.path.join(COVER_THUMB_FOLDER, name))
+        # exact match only: a prefix glob would also take "<stem>_Shippuden_..." thumbnails of other titles
+        own = re.compile(rf"{re.escape(stem)}_\d+\.webp")
+        for old in os.listdir(COVER_THUMB_FOLDER):
+            if old != name and own.fullmatch(old):
+                try: os.remove(os.path.join(COVER_THUMB_FOLDER, old))
+                except OSError: pass
+        return f"covers/{name}", color
+    except Exception as e:
+        app.logger.warning("Cover thumbnail failed for %s: %s", cover_fs, e)
+        return None, None
+
+@app.cli.command("cover-thumbs")
+def cover_thumbs():
+    """(Re)build thumbnails and placeholder colours for every approved manga with a cover."""
+    done = 0
+    for m in query_all("SELECT manga_id, CoverPath FROM manga WHERE CoverPath IS NOT NULL AND CoverPath <> ''"):
+        rel = m["CoverPath"]
+        parts = rel.split("/")
+        cover_fs = os.path.join(app.static_folder, rel.replace("/", os.sep))
+        if not os.path.isfile(cover_fs):
+            continue
+        thumb, color = make_cover_thumb(cover_fs, parts[1] if len(parts) > 2 else str(m["manga_id"]))
+        if thumb:
+            execute("UPDATE manga SET ThumbPath=%s, CoverColor=%s WHERE manga_id=%s",
+                    (thumb, color, m["manga_id"]))
+            invalidate("catalog", f"manga:{m['manga_id']}")
+            done += 1
+    click.echo(f"Built {done} cover thumbnails.")
+
 # Content Approval #
 @app.route('/dashboard/content/<folder>/approve', methods=['POST', 'GET'])
 @content_manager_required
@@ -632,10 +1998,14 @@ def content_approve(folder):
         cover_rel = f"Resources/{folder}/Cover.jpg"
 
     exists = query_one("SELECT manga_id, CoverPath FROM manga WHERE Title=%s", (title,))
+    # thumbnails are only made where the row is written: make_cover_thumb drops the title's older ones
     if exists:
         if cover_rel and not exists.get("CoverPath"):
+            thumb_rel, cover_color = make_cover_thumb(cover_fs, folder)
             try:
-                execute("UPDATE manga SET CoverPath=%s WHERE manga_id=%s", (cover_rel, exists["manga_id"]))
+                execute("UPDATE manga SET CoverPath=%s, ThumbPath=%s, CoverColor=%s WHERE manga_id=%s",
+                        (cover_rel, thumb_rel, cover_color, exists["manga_id"]))
+                invalidate("catalog", f"manga:{exists['manga_id']}")
                 flash("Already approved. CoverPath was missing and is now set.", "info")
             except Exception as e:
                 flash(f"Already approved; failed to set CoverPath: {e}", "warning")
@@ -643,6 +2013,7 @@ def content_approve(folder):
             flash("Already approved.", "info")
         return redirect(url_for('content_detail', folder=folder))
 
+    thumb_rel, cover_color = make_cover_thumb(cover_fs, folder) if cover_rel else (None, None)
     cols = ["publication_status", "Title", "Author_name", "synopsis"]
     vals = [
         meta.get("publication_status") or "unknown",
@@ -653,6 +2024,9 @@ def content_approve(folder):
     if cover_rel:
         cols.append("CoverPath")
         vals.append(cover_rel)
+    if thumb_rel:
+        cols += ["ThumbPath", "CoverColor"]
+        vals += [thumb_rel, cover_color]
     if u and u.get("user_id") is not None:
         cols.append("user_id")
         vals.append(u["user_id"])
@@ -665,6 +2039,7 @@ def content_approve(folder):
 
     try:
         execute(sql, tuple(vals))
+        invalidate("catalog")
         flash("Manga approved and stored in database (with cover).", "success")
     except Exception as e:
         flash(f"DB insert failed: {e}", "danger")
@@ -685,6 +2060,7 @@ def content_remove(folder):
     if row:
         try:
             execute("DELETE FROM manga WHERE manga_id=%s", (row["manga_id"],))
+            invalidate("catalog", f"manga:{row['manga_id']}")
             flash("Manga removed from database. Files were left untouched in static/Resources.", "success")
         except Exception as e:
             flash(f"Failed to delete from database: {e}", "danger")
@@ -693,24 +2069,531 @@ def content_remove(folder):
     return redirect(url_for('content_dashboard'))
 
 
+# Chapter archives (.cbz/.zip) #
+
+# a chapter may also be Resources/<folder>/<chapter>.cbz; pages are read from the archive in place
+ARCHIVE_EXTS = ('.cbz', '.zip')
+_ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+class ChapterArchive:
+    """A chapter archive opened once: central directory parsed and the file memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self._fh = open(path, "rb")
+        self.mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zf = zipfile.ZipFile(self._fh)
+        infos = [
+            i for i in self.zf.infolist()
+            if not i.is_dir() and not i.filename.startswith("__MACOSX/")
+            and os.path.splitext(i.filename)[1].lower() in IMAGE_EXTS
+        ]
+        # same order list_images gives for a folder; entries may sit in a sub-folder inside the zip
+        infos.sort(key=lambda i: natural_sort_key(i.filename))
+        self.pages = {i.filename: i for i in infos}
+
+    def member_view(self, info):
+        """Zero-copy view of a stored (uncompressed) member's bytes, or None if it's compressed."""
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        sig, *_, name_len, extra_len = _ZIP_LOCAL_HEADER.unpack_from(self.mm, info.header_offset)
+        if sig != b"PK\x03\x04":
+            return None
+        start = info.header_offset + _ZIP_LOCAL_HEADER.size + name_len + extra_len
+        return memoryview(self.mm)[start:start + info.file_size]
+
+    def open_member(self, info):
+        return self.zf.open(info)
+
+@functools.lru_cache(maxsize=64)
+def _open_archive(path, mtime):
+    return ChapterArchive(path)
+
+def open_archive(path):
+    return _open_archive(path, os.path.getmtime(path))
+
+def is_archive_name(name):
+    return name.lower().endswith(ARCHIVE_EXTS)
+
+def chapter_source(folder, chapter):
+    """("pack" | "dir" | "archive", path) for a chapter, or (None, None) if it doesn't exist.
+    A packed chapter is read from its pack even if the loose folder was kept, unless the pack is damaged."""
+    base = resources_root()
+    pack = safe_join(base, folder, chapter + PACK_EXT)
+    if pack and os.path.isfile(pack):
+        try:
+            open_pack(pack)
+            return "pack", pack
+        except (OSError, ValueError) as e:
+            app.logger.warning("Unreadable pack %s, using the loose pages: %s", pack, e)
+    chapter_dir = safe_join(base, folder, chapter)
+    if chapter_dir and os.path.isdir(chapter_dir):
+        return "dir", chapter_dir
+    for ext in ARCHIVE_EXTS:
+        path = safe_join(base, folder, chapter + ext)
+        if path and os.path.isfile(path):
+            return "archive", path
+    return None, None
+
+def serve_archive_member(archive, info):
+    """Send one page out of an archive: byte ranges straight from the mmap for stored entries."""
+    mimetype = mimetypes.guess_type(info.filename)[0] or "application/octet-stream"
+    etag = f"{int(archive.mtime)}-{info.header_offset}-{info.file_size}"
+    view = archive.member_view(info)
+    if view is not None:
+        return serve_mapped(view, mimetype, etag, archive.mtime)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    # deflated entry: stream it decompressed, no range support
+    def inflate():
+        with archive.open_member(info) as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+    resp = Response(inflate(), mimetype=mimetype, direct_passthrough=True)
+    resp.content_length = info.file_size
+    resp.set_etag(etag)
+    resp.last_modified = datetime.utcfromtimestamp(archive.mtime)
+    resp.headers["Cache-Control"] = "public, max-age=604800"
+    return resp
+
+
+# Packed chapters (.mfapack) #
+
+# flask pack-chapters turns Resources/<folder>/<chapter>/ into Resources/<folder>/<chapter>.mfapack:
+#   magic | page bytes ... | JSON index [[name, offset, length, mtime], ...] | footer (index offset, index length, magic)
+# a repack writes a new file next to the old one (unchanged pages copied from the old pack, changed ones
+# from the folder) and renames it over, so readers only ever see a complete pack
+PACK_EXT = ".mfapack"
+PACK_MAGIC = b"MFAPACK1"
+_PACK_FOOTER = struct.Struct("<QQ8s")
+
+def _read_pack_index(f):
+    """{name: (offset, length, mtime)} in reading order from a pack (file or mmap); ValueError if it isn't one."""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if end < len(PACK_MAGIC) + _PACK_FOOTER.size:
+        raise ValueError("truncated pack")
+    f.seek(end - _PACK_FOOTER.size)
+    idx_off, idx_len, magic = _PACK_FOOTER.unpack(f.read(_PACK_FOOTER.size))
+    if magic != PACK_MAGIC or idx_off + idx_len > end - _PACK_FOOTER.size:
+        raise ValueError("bad pack footer")
+    f.seek(idx_off)
+    return {name: (off, length, mtime) for name, off, length, mtime in json.loads(f.read(idx_len))}
+
+class ChapterPack:
+    """A packed chapter, memory-mapped once; pages are slices of the mapping."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, "rb") as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pages = _read_pack_index(self.mm)
+
+    def page_view(self, name):
+        off, length, _ = self.pages[name]
+        return memoryview(self.mm)[off:off + length]
+
+@functools.lru_cache(maxsize=256)
+def _open_pack(path, mtime):
+    return ChapterPack(path)
+
+def open_pack(path):
+    return _open_pack(path, os.path.getmtime(path))
+
+def pack_chapter(chapter_dir, pack_path):
+    """Add chapter_dir's pages to its pack (creating it if needed). Returns bytes of page data written."""
+    names = list_images(chapter_dir)
+    old = {}
+    try:
+        with open(pack_path, "rb") as f:
+            old = _read_pack_index(f)
+    except (OSError, ValueError):
+        old = {}
+
+    stats = {n: os.stat(os.path.join(chapter_dir, n)) for n in names}
+    fresh = [n for n in names if n in old and old[n][1] == stats[n].st_size and old[n][2] >= stats[n].st_mtime]
+    if len(fresh) == len(names) == len(old) and list(old) == names:
+        return 0  # up to date
+
+    tmp = f"{pack_path}.{os.getpid()}.tmp"
+    written = 0
+    try:
+        with open(tmp, "wb") as f, (open(pack_path, "rb") if fresh else io.BytesIO()) as prev:
+            f.write(PACK_MAGIC)
+            index = []
+            for n in names:
+                off = f.tell()
+                if n in fresh:
+                    prev.seek(old[n][0])
+                    f.write(prev.read(old[n][1]))
+                    index.append([n, off, old[n][1], old[n][2]])
+                    continue
+                with open(os.path.join(chapter_dir, n), "rb") as src:
+                    shutil.copyfileobj(src, f, UPLOAD_CHUNK)
+                index.append([n, off, f.tell() - off, stats[n].st_mtime])
+                written += f.tell() - off
+            data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+            idx_off = f.tell()
+            f.write(data)
+            f.write(_PACK_FOOTER.pack(idx_off, len(data), PACK_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, pack_path)
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+    return written
+
+def serve_mapped(view, mimetype, etag, mtime):
+    """Send bytes held in a memory mapping, honouring If-None-Match and a single byte Range."""
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    size = len(view)
+    start, stop, status = 0, size, 200
+    if request.range is not None:
+        rng = request.range.range_for_length(size)
+        if rng is None:
+            resp = Response(status=416)
+            resp.content_range = ContentRange("bytes", None, None, size)
+            return resp
+        (start, stop), status = rng, 206
+
+    def chunks():
+        for pos in range(start, stop, UPLOAD_CHUNK):
+            yield bytes(view[pos:min(pos + UPLOAD_CHUNK, stop)])
+    resp = Response(chunks(), status=status, mimetype=mimetype, direct_passthrough=True)
+    resp.content_length = stop - start
+    resp.accept_ranges = "bytes"
+    if status == 206:
+        resp.content_range = ContentRange("bytes", start, stop, size)
+    resp.set_etag(etag)
+    resp.last_modified = datetime.utcfromtimestamp(mtime)
+    resp.headers["Cache-Control"] = "public, max-age=604800"
+    return resp
+
+def serve_pack_page(pack, name):
+    off, length, _ = pack.pages[name]
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return serve_mapped(pack.page_view(name), mimetype, f"p{int(pack.mtime)}-{off}-{length}", pack.mtime)
+
+@app.cli.command("pack-chapters")
+@click.option("--folder", default=None, help="Only this manga folder.")
+@click.option("--remove-loose", is_flag=True,
+              help="Delete the page files after packing (the reader then has no resized or WebP/AVIF variants for them).")
+def pack_chapters(folder, remove_loose):
+    """Pack each chapter folder into a single .mfapack file (incremental; re-run after changing pages)."""
+    base = resources_root()
+    packed = total = 0
+    for f in ([folder] if folder else list_dir_sorted(base)):
+        fpath = os.path.join(base, f)
+        if not os.path.isdir(fpath):
+            continue
+        for ch in list_dir_sorted(fpath):
+            ch_dir = os.path.join(fpath, ch)
+            if not is_chapter_folder(ch) or not os.path.isdir(ch_dir) or not list_images(ch_dir):
+                continue
+            written = pack_chapter(ch_dir, os.path.join(fpath, ch + PACK_EXT))
+            total += written
+            packed += 1
+            if remove_loose:
+                for n in list_images(ch_dir):
+                    os.remove(os.path.join(ch_dir, n))
+                try:
+                    os.rmdir(ch_dir)
+                except OSError:
+                    click.echo(f"{f}/{ch}: left in place (holds non-page files)")
+            click.echo(f"{f}/{ch}: {written} bytes packed")
+    click.echo(f"Packed {packed} chapters, {total} bytes of pages written.")
+
+# Chapter manifests #
+
+# page list + intrinsic sizes per chapter, computed once and kept in cache/manifests/<folder>/<chapter>.json
+MANIFEST_DIR = os.getenv("MANIFEST_DIR", os.path.join(app.root_path, "cache", "manifests"))
+MANIFEST_VERSION = 3  # bump when the page entry fields change; older cached files are rebuilt
+VIRTUAL_READER_MIN_PAGES = 80  # longer chapters open in the virtualised reader by default
+READER_SIZES = "(max-width: 1065px) 92vw, 980px"
+PRELOAD_PAGES = 3  # first pages of this chapter (preload) and the next one (prefetch) sent as Link headers
+
+def _page_size(path):
+    try:
+        with Image.open(path) as img:  # only parses the header
+            return img.width, img.height
+    except Exception:
+        return None, None
+
+def _source_stamp(source):
+    """Changes whenever the chapter's pages do. A page replaced in place leaves the folder's mtime alone,
+    so folders also fold in every entry's size and newest mtime/ctime (ctime moves on rename too)."""
+    st = os.stat(source)
+    if not os.path.isdir(source):
+        return f"{st.st_mtime_ns}:{st.st_size}"
+    count = total = latest = 0
+    with os.scandir(source) as it:
+        for e in it:
+            est = e.stat()
+            count += 1
+            total += est.st_size
+            latest = max(latest, est.st_mtime_ns, est.st_ctime_ns)
+    return f"{st.st_mtime_ns}:{count}:{total}:{latest}"
+
+@functools.lru_cache(maxsize=256)
+def _manifest_for(source, folder, chapter, stamp):
+    # stamp is part of the cache key: adding, removing or replacing pages (or the archive) changes it
+    cache_fs = os.path.join(MANIFEST_DIR, folder, chapter + ".json")
+    try:
+        with open(cache_fs, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("stamp") == stamp and data.get("version") == MANIFEST_VERSION:
+            return data["pages"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    pages = []
+    if os.path.isdir(source):
+        for fn in list_images(source):
+            path = os.path.join(source, fn)
+            w, h = _page_size(path)
+            pages.append({"name": fn, "w": w, "h": h, "size": os.path.getsize(path)})
+    elif source.endswith(PACK_EXT):
+        pack = open_pack(source)
+        for name, (_, length, _) in pack.pages.items():
+            w, h = _page_size(io.BytesIO(pack.page_view(name)))
+            pages.append({"name": name, "w": w, "h": h, "size": length})
+    else:
+        archive = open_archive(source)
+        for name, info in archive.pages.items():
+            with archive.open_member(info) as f:
+                w, h = _page_size(f)
+            pages.append({"name": name, "w": w, "h": h, "size": info.file_size})
+    try:
+        os.makedirs(os.path.dirname(cache_fs), exist_ok=True)
+        tmp = f"{cache_fs}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "stamp": stamp, "pages": pages}, f)
+        os.replace(tmp, cache_fs)
+    except OSError as e:
+        app.logger.warning("Failed to write chapter manifest %s: %s", cache_fs, e)
+    return pages
+
+def chapter_manifest(folder, chapter):
+    """[{name, w, h, size}, ...] for a chapter (folder or archive) in reading order, or None if it doesn't exist."""
+    kind, source = chapter_source(folder, chapter)
+    if not kind:
+        return None
+    return _manifest_for(source, folder, chapter, _source_stamp(source))
+
+
+# Chapter-read counters (write-behind) #
+
+# reads are counted in memory per user and written in one batched UPDATE every few seconds,
+# so the reader never waits on (or contends for) the users row
+READ_FLUSH_SECONDS = float(os.getenv("READ_FLUSH_SECONDS", "5"))
+READ_FLUSH_EVENTS = 200         # flush early once this many reads are pending
+READ_BUFFER_MAX_USERS = 10000   # bound on distinct pending users; reads beyond it are dropped
+READ_FLUSH_BATCH = 500          # users per UPDATE statement
+
+_read_lock = threading.Lock()
+_read_counts = {}
+_read_pending = 0
+_read_dropped = 0
+_read_wakeup = threading.Event()
+_read_flusher = None
+
+def _flush_loop():
+    while True:
+        _read_wakeup.wait(READ_FLUSH_SECONDS)
+        _read_wakeup.clear()
+        flush_chapter_reads()
+        flush_progress()
+
+def _ensure_flusher():
+    # started lazily so forked workers and CLI commands each get their own (or none)
+    global _read_flusher
+    if _read_flusher is None:
+        _read_flusher = threading.Thread(target=_flush_loop, name="write-behind", daemon=True)
+        _read_flusher.start()
+
+def buffer_chapter_read(uid):
+    global _read_pending, _read_dropped
+    with _read_lock:
+        if uid not in _read_counts and len(_read_counts) >= READ_BUFFER_MAX_USERS:
+            _read_dropped += 1
+            _read_wakeup.set()
+            return
+        _read_counts[uid] = _read_counts.get(uid, 0) + 1
+        _read_pending += 1
+        _ensure_flusher()
+        if _read_pending >= READ_FLUSH_EVENTS:
+            _read_wakeup.set()
+
+def flush_chapter_reads():
+    """Write all pending read counts. On failure they are merged back for the next flush."""
+    global _read_counts, _read_pending
+    with _read_lock:
+        batch, _read_counts, _read_pending = _read_counts, {}, 0
+    items = list(batch.items())
+    for i in range(0, len(items), READ_FLUSH_BATCH):
+        chunk = items[i:i + READ_FLUSH_BATCH]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        ids = ",".join(["%s"] * len(chunk))
+        params = [v for pair in chunk for v in pair] + [uid for uid, _ in chunk]
+        try:
+            execute(
+                f"UPDATE users SET no_of_chapters_read = COALESCE(no_of_chapters_read, 0) + "
+                f"CASE user_id {cases} END WHERE user_id IN ({ids})",
+                tuple(params)
+            )
+        except Exception:
+            app.logger.exception("Failed to flush %d chapter-read counters; will retry", len(chunk))
+            with _read_lock:
+                for uid, n in chunk:
+                    _read_counts[uid] = _read_counts.get(uid, 0) + n
+                    _read_pending += n
+
+atexit.register(flush_chapter_reads)
+
+
+# Reading progress #
+
+# last chapter/page per (user, manga folder). Beacons land in _progress_pending and are upserted by
+# the write-behind thread. Shelves are kept in the shared cache under the user's "progress:<uid>" tag,
+# which each flush bumps, so every worker sees a flushed beacon; this worker's unflushed ones are laid
+# on top of whatever shelf it reads
+PROGRESS_CACHE_TTL = 600
+PROGRESS_SHELF_SIZE = 12
+
+_progress_lock = threading.Lock()
+_progress_pending = {}               # uid -> {folder: (chapter, page, datetime)}
+_progress_pending_count = 0
+
+def buffer_progress(uid, folder, chapter, page):
+    global _progress_pending_count
+    now = datetime.utcnow()
+    with _progress_lock:
+        mine = _progress_pending.get(uid)
+        if (mine is None or folder not in mine) and _progress_pending_count >= READ_BUFFER_MAX_USERS:
+            _read_wakeup.set()
+            return
+        mine = _progress_pending.setdefault(uid, {})
+        if folder not in mine:
+            _progress_pending_count += 1
+        mine[folder] = (chapter, page, now)
+    _ensure_flusher()
+
+def flush_progress():
+    global _progress_pending, _progress_pending_count
+    with _progress_lock:
+        batch, _progress_pending, _progress_pending_count = _progress_pending, {}, 0
+    items = [((uid, folder), val) for uid, shelf in batch.items() for folder, val in shelf.items()]
+    for i in range(0, len(items), READ_FLUSH_BATCH):
+        chunk = items[i:i + READ_FLUSH_BATCH]
+        params = []
+        for (uid, folder), (chapter, page, when) in chunk:
+            params += [uid, folder, chapter, page, when]
+        try:
+            execute(
+                "INSERT INTO reading_progress (user_id, manga_folder, chapter, page, updated_at) VALUES "
+                + ",".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+                + " ON DUPLICATE KEY UPDATE chapter=VALUES(chapter), page=VALUES(page), updated_at=VALUES(updated_at)",
+                tuple(params)
+            )
+        except Exception:
+            app.logger.exception("Failed to flush %d reading-progress rows; will retry", len(chunk))
+            with _progress_lock:
+                for (uid, folder), val in chunk:
+                    mine = _progress_pending.setdefault(uid, {})
+                    if folder not in mine:
+                        mine[folder] = val
+                        _progress_pending_count += 1
+            continue
+        invalidate(*{f"progress:{uid}" for (uid, _), _ in chunk})
+
+atexit.register(flush_progress)
+
+def user_progress(uid):
+    """{folder: {"chapter", "page", "updated_at"}} for a user, most recent first."""
+    version = tag_version(f"progress:{uid}")
+    key = f"progress:{uid}@{version}"
+    shelf = cache.get(key) if version is not None else None
+    if shelf is None:
+        rows = query_all("""
+            SELECT manga_folder, chapter, page, updated_at
+            FROM reading_progress
+            WHERE user_id=%s
+            ORDER BY updated_at DESC
+            LIMIT %s
+        """, (uid, PROGRESS_SHELF_SIZE))
+        shelf = {r["manga_folder"]: {"chapter": r["chapter"], "page": r["page"], "updated_at": r["updated_at"]}
+                 for r in rows}
+        if version is not None:
+            cache.set(key, shelf, PROGRESS_CACHE_TTL)
+    shelf = dict(shelf)
+    with _progress_lock:
+        # beacons that arrived here but aren't flushed yet win over what the DB has
+        for folder, (chapter, page, when) in _progress_pending.get(uid, {}).items():
+            shelf[folder] = {"chapter": chapter, "page": page, "updated_at": when}
+    return dict(sorted(shelf.items(), key=lambda kv: kv[1]["updated_at"], reverse=True))
+
+def continue_reading(uid, limit=6):
+    """Shelf entries for templates: title, chapter, page and the reader URL to resume at."""
+    items = []
+    for folder, p in list(user_progress(uid).items())[:limit]:
+        meta = parse_manga_txt(os.path.join(resources_root(), folder, "manga.txt"))
+        items.append({
+            "folder": folder,
+            "title": meta.get("Title") or folder,
+            "chapter": p["chapter"],
+            "page": p["page"],
+            "url": url_for("reader", folder=folder, chapter=p["chapter"]) + f"#p={p['page'] + 1}",
+        })
+    return items
+
+@app.post('/api/progress')
+def progress_beacon():
+    """navigator.sendBeacon target from the reader: folder, chapter, page (0-based)."""
+    uid = session.get("user_id")
+    data = request.get_json(silent=True) or request.form
+    folder = (data.get("folder") or "").strip()
+    chapter = (data.get("chapter") or "").strip()
+    try:
+        page = max(0, int(data.get("page") or 0))
+    except (TypeError, ValueError):
+        page = 0
+    if uid and folder and chapter and chapter_manifest(folder, chapter) is not None:
+        buffer_progress(uid, folder, chapter, page)
+    return "", 204
+
 # Reader
 
-@app.route('/reader/<folder>/<chapter>')
-def reader(folder, chapter):
+def reader_data(folder, chapter):
+    """Everything the reader needs for one chapter, shared by the HTML page and /api/reader."""
     base = resources_root()
-    chapter_dir = os.path.join(base, folder, chapter)
-    if not os.path.isdir(chapter_dir):
-        abort(404)
+    manifest = chapter_manifest(folder, chapter)
+    if manifest is None:
+        return None
 
-    files = list_images(chapter_dir)
-    pages = [f"/static/Resources/{folder}/{chapter}/{fn}" for fn in files]
+    loose = os.path.isdir(os.path.join(base, folder, chapter))  # resized variants exist for loose files only
+    pages = []
+    for p in manifest:
+        url = resource_url(f"Resources/{folder}/{chapter}/{p['name']}")
+        pages.append({"src": url, "srcset": page_srcset(folder, chapter, p["name"], p["w"], url) if loose else "",
+                      "w": p["w"], "h": p["h"]})
+    virtual = request.args.get("virtual")
+    virtual = virtual == "1" if virtual in ("0", "1") else len(pages) >= VIRTUAL_READER_MIN_PAGES
 
     manga_dir = os.path.join(base, folder)
-    siblings = [
-        d for d in os.listdir(manga_dir)
-        if os.path.isdir(os.path.join(manga_dir, d)) and is_chapter_folder(d)
-    ]
-    siblings.sort(key=chapter_sort_key)
+    siblings = list_chapters(manga_dir)
 
     try:
         idx = siblings.index(chapter)
@@ -721,22 +2604,544 @@ def reader(folder, chapter):
 
     meta = parse_manga_txt(os.path.join(manga_dir, "manga.txt"))
     title = meta.get("Title") or folder
-
     _num = re.search(r'\d+', chapter)
-    chapter_ctx = {"number": _num.group() if _num else chapter, "title": f"{title} · {chapter}"}
 
-    u = current_user()
-    if u:
+    def link(ch):
+        if not ch:
+            return None
+        return {"chapter": ch,
+                "url": url_for("reader", folder=folder, chapter=ch),
+                "api": url_for("reader_api", folder=folder, chapter=ch)}
+
+    nxt = link(next_ch)
+    if nxt:
+        nxt["pages"] = []
+        next_loose = chapter_source(folder, next_ch)[0] == "dir"
+        for p in (chapter_manifest(folder, next_ch) or [])[:PRELOAD_PAGES]:
+            url = resource_url(f"Resources/{folder}/{next_ch}/{p['name']}")
+            srcset = page_srcset(folder, next_ch, p["name"], p["w"], url) if next_loose else ""
+            nxt["pages"].append({"src": url, "srcset": srcset})
+
+    return {
+        "folder": folder,
+        "chapter": chapter,
+        "number": _num.group() if _num else chapter,
+        "title": f"{title} · {chapter}",
+        "url": url_for("reader", folder=folder, chapter=chapter),
+        "api": url_for("reader_api", folder=folder, chapter=chapter),
+        "virtual": virtual,
+        "sizes": READER_SIZES,
+        "pages": pages,
+        "prev": link(prev_ch),
+        "next": nxt,
+    }
+
+def record_chapter_read(folder, chapter):
+    # browser prefetches of the next chapter are not reads
+    if "prefetch" in (request.headers.get("Sec-Purpose") or request.headers.get("Purpose") or ""):
+        return
+    uid = session.get("user_id")
+    if not uid:
+        return
+    # re-opening the chapter you're already on (refresh, back) is not another read
+    if (user_progress(uid).get(folder) or {}).get("chapter") == chapter:
+        return
+    buffer_chapter_read(uid)
+    buffer_progress(uid, folder, chapter, 0)
+
+@app.route('/reader/<folder>/<chapter>')
+def reader(folder, chapter):
+    data = reader_data(folder, chapter)
+    if data is None:
+        abort(404)
+    record_chapter_read(folder, chapter)
+
+    pages = data["pages"]
+    nxt = data["next"]
+    resp = make_response(render_template(
+        "reader.html", folder=folder, reader_data=data,
+        chapter={"number": data["number"], "title": data["title"]},
+        pages=[p["src"] for p in pages], srcsets=[p["srcset"] for p in pages],
+        dims=[[p["w"], p["h"]] for p in pages], virtual=data["virtual"], sizes=READER_SIZES,
+        prev_chapter=data["prev"] and data["prev"]["chapter"],
+        next_chapter=nxt and nxt["chapter"]))
+
+    # lets the browser (or a proxy turning these into 103 Early Hints) start on images before parsing HTML
+    links = []
+    for p in pages[:PRELOAD_PAGES]:
+        link = f"<{p['src']}>; rel=preload; as=image"
+        if p["srcset"]:
+            link += f'; imagesrcset="{p["srcset"]}"; imagesizes="{READER_SIZES}"'
+        links.append(link)
+    if nxt:
+        links += [f"<{p['src']}>; rel=prefetch; as=image" for p in nxt["pages"]]
+    if links:
+        resp.headers["Link"] = ", ".join(links)
+    return resp
+
+@app.get('/api/reader/<folder>/<chapter>')
+def reader_api(folder, chapter):
+    """Chapter JSON for in-place chapter switching in ui.js."""
+    data = reader_data(folder, chapter)
+    if data is None:
+        abort(404)
+    record_chapter_read(folder, chapter)
+    resp = make_response(json.dumps(data, sort_keys=True, separators=(",", ":")))
+    resp.mimetype = "application/json"
+    resp.set_etag(hashlib.sha1(resp.get_data()).hexdigest())
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# Chapter downloads (streamed .cbz) #
+
+ZIP_MAX32 = 0xFFFFFFFF
+
+class StoredZipStream:
+    """
+    Builds a ZIP of stored (uncompressed) entries as a stream of byte chunks: nothing is buffered
+    beyond one read chunk, CRCs go in data descriptors after each entry, and ZIP64 records are used
+    only when an entry, offset or the entry count needs them. predict_size() runs the same layout
+    rules, so a Content-Length can be sent before the first byte.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.central = []
+
+    @staticmethod
+    def _dos_time(ts):
+        t = time.localtime(max(ts, 315532800))  # ZIP can't store dates before 1980
+        return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+               ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+    @staticmethod
+    def _entry_size(name_len, size, offset):
+        z64 = size >= ZIP_MAX32 or offset >= ZIP_MAX32
+        local = 30 + name_len + (20 if z64 else 0) + size + (24 if z64 else 16)
+        central = 46 + name_len + (28 if z64 else 0)
+        return local, central
+
+    @staticmethod
+    def _end_size(count, cd_offset, cd_size):
+        z64 = count > 0xFFFF or cd_offset >= ZIP_MAX32 or cd_size >= ZIP_MAX32
+        return (56 + 20 if z64 else 0) + 22
+
+    @classmethod
+    def predict_size(cls, entries):
+        """entries: iterable of (name, size) in write order."""
+        offset = cd_size = count = 0
+        for name, size in entries:
+            local, central = cls._entry_size(len(name.encode("utf-8")), size, offset)
+            offset += local
+            cd_size += central
+            count += 1
+        return offset + cd_size + cls._end_size(count, offset, cd_size)
+
+    def entry(self, name, size, fileobj, mtime):
+        """Yield one entry's bytes, reading fileobj in chunks; stops if it isn't `size` bytes long."""
+        bname = name.encode("utf-8")
+        z64 = size >= ZIP_MAX32 or self.offset >= ZIP_MAX32
+        dos_time, dos_date = self._dos_time(mtime)
+        flags = 0x0808  # sizes/CRC in a data descriptor, UTF-8 names
+        version = 45 if z64 else 20
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if z64 else b""
+        header = struct.pack("<IHHHHHIIIHH", 0x04034b50, version, flags, 0, dos_time, dos_date,
+                             0, ZIP_MAX32 if z64 else 0, ZIP_MAX32 if z64 else 0, len(bname), len(extra))
+        start = self.offset
+        yield header + bname + extra
+
+        crc = 0
+        written = 0
+        while True:
+            chunk = fileobj.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > size:
+                break
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if written != size:
+            # the file changed since the manifest was built; the declared length is now wrong
+            raise IOError(f"{name}: expected {size} bytes, read {written}")
+
+        if z64:
+            yield struct.pack("<IIQQ", 0x08074b50, crc, size, size)
+        else:
+            yield struct.pack("<IIII", 0x08074b50, crc, size, size)
+        self.offset += self._entry_size(len(bname), size, start)[0]
+        self.central.append((bname, size, start, crc, dos_time, dos_date, z64))
+
+    def finish(self):
+        cd_offset = self.offset
+        parts = []
+        for bname, size, start, crc, dos_time, dos_date, z64 in self.central:
+            version = 45 if z64 else 20
+            extra = struct.pack("<HHQQQ", 1, 24, size, size, start) if z64 else b""
+            small = ZIP_MAX32 if z64 else size
+            parts.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, version, version, 0x0808, 0,
+                                     dos_time, dos_date, crc, small, small, len(bname), len(extra),
+                                     0, 0, 0, 0, ZIP_MAX32 if z64 else start) + bname + extra)
+        cd = b"".join(parts)
+        count = len(self.central)
+        end = b""
+        if count > 0xFFFF or cd_offset >= ZIP_MAX32 or len(cd) >= ZIP_MAX32:
+            z64_offset = cd_offset + len(cd)
+            end += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, len(cd), cd_offset)
+            end += struct.pack("<IIQI", 0x07064b50, 0, z64_offset, 1)
+            end += struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP_MAX32, ZIP_MAX32, 0)
+        else:
+            end += struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, len(cd), cd_offset, 0)
+        yield cd + end
+
+def open_page(folder, chapter, name):
+    """File object for one page, whether the chapter is a folder or an archive."""
+    kind, source = chapter_source(folder, chapter)
+    if kind == "dir":
+        return open(os.path.join(source, name), "rb")
+    if kind == "pack":
+        return io.BytesIO(open_pack(source).page_view(name))
+    if kind == "archive":
+        archive = open_archive(source)
+        return archive.open_member(archive.pages[name])
+    raise FileNotFoundError(f"{folder}/{chapter}/{name}")
+
+def _cbz_entries(folder, chapter, prefix=""):
+    """(zip name, size, page name) for a chapter; pages are renumbered so any reader sorts them right."""
+    manifest = chapter_manifest(folder, chapter) or []
+    for i, p in enumerate(manifest, 1):
+        ext = os.path.splitext(p["name"])[1].lower()
+        yield f"{prefix}{i:04d}{ext}", p["size"], p["name"]
+
+def _cbz_stream(z, folder, chapter, entries, mtime):
+    for zname, size, name in entries:
+        try:
+            with open_page(folder, chapter, name) as f:
+                yield from z.entry(zname, size, f, mtime)
+        except OSError:
+            # only a page changed mid-download gets here (the manifest is checked against every page's
+            # size and mtime first); the Content-Length is already out, so the download has to fail
+            app.logger.warning("Download of %s/%s aborted: %s changed while streaming", folder, chapter, name)
+            raise
+
+def _cbz_response(stream_body, filename, length):
+    resp = Response(stream_body, mimetype="application/vnd.comicbook+zip", direct_passthrough=True)
+    resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"
+    if length is not None:
+        resp.content_length = length
+    return resp
+
+@app.route('/download/<folder>/<chapter>')
+@login_required
+def download_chapter(folder, chapter):
+    if chapter_manifest(folder, chapter) is None:
+        abort(404)
+    entries = list(_cbz_entries(folder, chapter))
+    mtime = os.path.getmtime(chapter_source(folder, chapter)[1])
+
+    def body():
+        z = StoredZipStream()
+        yield from _cbz_stream(z, folder, chapter, entries, mtime)
+        yield from z.finish()
+
+    length = StoredZipStream.predict_size((n, s) for n, s, _ in entries)
+    return _cbz_response(body(), f"{folder} - {chapter}.cbz", length)
+
+@app.route('/download/<folder>')
+@login_required
+def download_series(folder):
+    manga_dir = safe_join(resources_root(), folder)
+    if not manga_dir or not os.path.isdir(manga_dir):
+        abort(404)
+    chapters = list_chapters(manga_dir)
+    # manifests are cached, so the length costs no page reads; it is skipped for very long series.
+    # The body streams the same entry lists the length was computed from.
+    listed = None
+    if len(chapters) <= 2000:
+        listed = {ch: list(_cbz_entries(folder, ch, prefix=f"{ch}/")) for ch in chapters}
+
+    def body():
+        z = StoredZipStream()
+        for ch in chapters:  # one chapter's manifest at a time
+            mtime = os.path.getmtime(chapter_source(folder, ch)[1])
+            entries = listed[ch] if listed is not None else _cbz_entries(folder, ch, prefix=f"{ch}/")
+            yield from _cbz_stream(z, folder, ch, entries, mtime)
+        yield from z.finish()
+
+    length = None
+    if listed is not None:
+        length = StoredZipStream.predict_size((n, s) for entries in listed.values() for n, s, _ in entries)
+    return _cbz_response(body(), f"{folder}.cbz", length)
+
+# Derived (resized) page images #
+
+# width variants offered to the browser through srcset; originals are never touched
+DERIVED_WIDTHS = (480, 960, 1600)
+DERIVED_CACHE_DIR = os.getenv("DERIVED_CACHE_DIR", os.path.join(app.root_path, "cache", "derived"))
+DERIVED_CACHE_MAX_BYTES = int(os.getenv("DERIVED_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+DERIVED_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP"}  # no GIF: keep animation
+
+_derived_lock = threading.Lock()
+_derived_bytes = None  # running total of the cache dir, filled on first use
+
+def derived_url(width, folder, chapter, fn):
+    # url_for quotes spaces, which would otherwise split srcset entries
+    return url_for("derived_page", width=width, folder=folder, chapter=chapter, fn=fn)
+
+def page_srcset(folder, chapter, fn, width=None, original_url=None):
+    """srcset for a page; with a known width, only narrower variants plus the original itself."""
+    if os.path.splitext(fn)[1].lower() not in DERIVED_FORMATS:
+        return ""
+    widths = [w for w in DERIVED_WIDTHS if not width or w < width]
+    if not widths:
+        return ""
+    entries = [f"{derived_url(w, folder, chapter, fn)} {w}w" for w in widths]
+    if width and original_url:
+        entries.append(f"{original_url} {width}w")
+    return ", ".join(entries)
+
+def render_derived(src, dst, width):
+    """Write a copy of src scaled down to `width` at dst. Returns bytes written, 0 if not needed."""
+    with Image.open(src) as img:
+        if img.width <= width:
+            return 0
+        height = round(img.height * width / img.width)
+        out = img.resize((width, height), Image.LANCZOS)
+    fmt = DERIVED_FORMATS[os.path.splitext(src)[1].lower()]
+    if fmt == "JPEG" and out.mode not in ("RGB", "L"):
+        out = out.convert("RGB")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    out.save(tmp, fmt, quality=82, optimize=True)
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+def _derived_cache_files():
+    for dirpath, _, names in os.walk(DERIVED_CACHE_DIR):
+        for n in names:
+            if not n.endswith(".tmp"):
+                yield os.path.join(dirpath, n)
+
+def _account_derived(added):
+    """Add to the cache size and evict least-recently-used variants when over budget."""
+    global _derived_bytes
+    with _derived_lock:
+        if _derived_bytes is None:
+            _derived_bytes = sum(os.path.getsize(p) for p in _derived_cache_files())
+        else:
+            _derived_bytes += added
+        if _derived_bytes <= DERIVED_CACHE_MAX_BYTES:
+            return
+        # mtime doubles as "last used": hits touch the file, so oldest mtime == LRU
+        entries = []
+        for p in _derived_cache_files():
             try:
-                execute(
-                    "UPDATE users SET no_of_chapters_read = COALESCE(no_of_chapters_read, 0) + 1 WHERE user_id=%s",
-                    (u["user_id"],)
-                )
+                st = os.stat(p)
+                entries.append((st.st_mtime, st.st_size, p))
+            except OSError:
+                pass
+        entries.sort()
+        target = int(DERIVED_CACHE_MAX_BYTES * 0.9)
+        total = sum(e[1] for e in entries)
+        for _, size, p in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+        _derived_bytes = total
+
+@app.route('/img/w/<int:width>/<folder>/<chapter>/<fn>')
+def derived_page(width, folder, chapter, fn):
+    src = safe_join(resources_root(), folder, chapter, fn)
+    if width not in DERIVED_WIDTHS or not src or not os.path.isfile(src):
+        abort(404)
+    if os.path.splitext(fn)[1].lower() not in DERIVED_FORMATS:
+        return send_path(src)
+
+    dst = os.path.join(DERIVED_CACHE_DIR, str(width), folder, chapter, fn)
+    if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        os.utime(dst)
+    else:
+        try:
+            written = render_derived(src, dst, width)
+        except Exception as e:
+            app.logger.warning("Derived image failed for %s: %s", src, e)
+            written = 0
+        if not written:
+            # source is already narrow enough (or undecodable): the original is the variant
+            return send_path(src)
+        _account_derived(written)
+
+    resp = send_path(dst)
+    resp.headers["Cache-Control"] = "public, max-age=604800"
+    return resp
+
+def _derive_chapter_job(chapter_dir, folder, chapter):
+    """Process-pool job: build every missing width variant for one chapter."""
+    written = 0
+    for fn in list_images(chapter_dir):
+        if os.path.splitext(fn)[1].lower() not in DERIVED_FORMATS:
+            continue
+        src = os.path.join(chapter_dir, fn)
+        for w in DERIVED_WIDTHS:
+            dst = os.path.join(DERIVED_CACHE_DIR, str(w), folder, chapter, fn)
+            if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+                continue
+            try:
+                written += render_derived(src, dst, w)
+            except Exception as e:
+                app.logger.warning("Derived image failed for %s: %s", src, e)
+    return written
+
+@app.cli.command("derive-pages")
+@click.option("--folder", default=None, help="Only this manga folder.")
+@click.option("--workers", default=os.cpu_count() or 2, show_default=True, type=int)
+def derive_pages(folder, workers):
+    """Eagerly build the reader's width variants for every chapter."""
+    base = resources_root()
+    jobs = []
+    for f in ([folder] if folder else list_dir_sorted(base)):
+        fpath = os.path.join(base, f)
+        if not os.path.isdir(fpath):
+            continue
+        for ch in list_dir_sorted(fpath):
+            ch_dir = os.path.join(fpath, ch)
+            if os.path.isdir(ch_dir) and is_chapter_folder(ch):
+                jobs.append((ch_dir, f, ch))
+
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(f, ch, pool.submit(_derive_chapter_job, ch_dir, f, ch)) for ch_dir, f, ch in jobs]
+        for f, ch, fut in futures:
+            written = fut.result()
+            total += written
+            click.echo(f"{f}/{ch}: {written} bytes")
+    _account_derived(total)
+    click.echo(f"Wrote {total} bytes of variants for {len(jobs)} chapters.")
+
+
+# Pre-encoded WebP/AVIF variants #
+
+# encoded copies live in a tree mirroring static/Resources: variants/<folder>/<chapter>/<file>.<fmt>
+VARIANT_DIR = os.getenv("VARIANT_DIR", os.path.join(app.root_path, "variants"))
+try:
+    AVIF_SUPPORTED = features.check("avif")
+except Exception:
+    AVIF_SUPPORTED = False
+# best first; only formats this Pillow can encode are produced by encode-variants
+VARIANT_FORMATS = [("image/avif", "avif", "AVIF")] if AVIF_SUPPORTED else []
+VARIANT_FORMATS += [("image/webp", "webp", "WEBP")]
+VARIANT_SOURCE_EXTS = ('.jpg', '.jpeg', '.png')
+
+def resource_url(rel):
+    """URL for a path under static/ that goes through the negotiating endpoint when it's a Resources image."""
+    rel = (rel or "").lstrip("/")
+    if rel.startswith("static/"):
+        rel = rel[len("static/"):]
+    if rel.startswith("Resources/"):
+        return url_for("resource_image", relpath=rel[len("Resources/"):])
+    return url_for("static", filename=rel)
+
+def _accepts_exactly(mime):
+    # browsers list image/avif and image/webp explicitly; a bare */* is not a promise to decode them
+    return any(value == mime and q > 0 for value, q in request.accept_mimetypes)
+
+def _variant_path(relpath, ext):
+    return os.path.join(VARIANT_DIR, relpath.replace("/", os.sep) + "." + ext)
+
+@app.route('/img/o/<path:relpath>')
+def resource_image(relpath):
+    src = safe_join(resources_root(), relpath)
+    if not src or not os.path.isfile(src):
+        # <folder>/<chapter>/<page> of a packed or .cbz/.zip chapter
+        parts = relpath.split("/", 2)
+        kind, arc_path = chapter_source(parts[0], parts[1]) if len(parts) == 3 else (None, None)
+        if kind == "pack":
+            pack = open_pack(arc_path)
+            if parts[2] not in pack.pages:
+                abort(404)
+            return serve_pack_page(pack, parts[2])
+        if kind != "archive":
+            abort(404)
+        archive = open_archive(arc_path)
+        info = archive.pages.get(parts[2])
+        if info is None:
+            abort(404)
+        return serve_archive_member(archive, info)
+    path, mime = src, None
+    if src.lower().endswith(VARIANT_SOURCE_EXTS):
+        src_mtime = os.path.getmtime(src)
+        for v_mime, ext, _ in VARIANT_FORMATS:
+            cand = _variant_path(relpath, ext)
+            if _accepts_exactly(v_mime) and os.path.isfile(cand) and os.path.getmtime(cand) >= src_mtime:
+                path, mime = cand, v_mime
+                break
+    resp = send_path(path, mimetype=mime)
+    resp.headers["Vary"] = "Accept"
+    resp.headers["Cache-Control"] = "public, max-age=604800"
+    return resp
+
+def _encode_dir_job(src_dir, rel_dir):
+    """Process-pool job: encode missing variants for the images directly in src_dir.
+    Returns (original bytes, bytes a best-variant client downloads instead)."""
+    before = after = 0
+    try:
+        names = sorted(os.listdir(src_dir), key=natural_sort_key)
+    except FileNotFoundError:
+        return 0, 0
+    for fn in names:
+        src = os.path.join(src_dir, fn)
+        if not fn.lower().endswith(VARIANT_SOURCE_EXTS) or not os.path.isfile(src):
+            continue
+        size = os.path.getsize(src)
+        best = size
+        for _, ext, fmt in VARIANT_FORMATS:
+            dst = _variant_path(f"{rel_dir}/{fn}", ext)
+            try:
+                if not (os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)):
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    with Image.open(src) as img:
+                        out = img if img.mode in ("RGB", "RGBA", "L") else img.convert("RGB")
+                        tmp = f"{dst}.{os.getpid()}.tmp"
+                        out.save(tmp, fmt, quality=70 if fmt == "AVIF" else 80)
+                    os.replace(tmp, dst)
+                best = min(best, os.path.getsize(dst))
             except Exception as e:
-                # Don't break the reader if the DB update fails
-                print("Failed to update chapter count:", e)
-    return render_template("reader.html", folder=folder, chapter=chapter_ctx, pages=pages,
-                           prev_chapter=prev_ch, next_chapter=next_ch)
+                app.logger.warning("%s encode of %s failed: %s", fmt, src, e)
+        before += size
+        after += best
+    return before, after
+
+@app.cli.command("encode-variants")
+@click.option("--folder", default=None, help="Only this manga folder.")
+@click.option("--workers", default=os.cpu_count() or 2, show_default=True, type=int)
+def encode_variants(folder, workers):
+    """Fill in missing WebP/AVIF copies of pages and covers and report the bytes saved."""
+    base = resources_root()
+    jobs = []  # (abs dir, path relative to Resources)
+    for f in ([folder] if folder else list_dir_sorted(base)):
+        fpath = os.path.join(base, f)
+        if not os.path.isdir(fpath):
+            continue
+        jobs.append((fpath, f))  # Cover.jpg
+        for ch in list_dir_sorted(fpath):
+            if os.path.isdir(os.path.join(fpath, ch)) and is_chapter_folder(ch):
+                jobs.append((os.path.join(fpath, ch), f"{f}/{ch}"))
+
+    click.echo("Formats: " + ", ".join(ext for _, ext, _ in VARIANT_FORMATS))
+    total_before = total_after = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(rel, pool.submit(_encode_dir_job, d, rel)) for d, rel in jobs]
+        for rel, fut in futures:
+            before, after = fut.result()
+            total_before += before
+            total_after += after
+            if before:
+                click.echo(f"{rel}: {before} -> {after} bytes (saved {before - after})")
+    click.echo(f"Total: {total_before} -> {total_after} bytes (saved {total_before - total_after})")
 
 
 # Resources - DB sync #
@@ -774,6 +3179,9 @@ def sync_from_resources_http():
         _, was_new = ensure_manga_row(folder, user)
         if was_new:
             created += 1
+    invalidate("resources")
+    if created:
+        invalidate("catalog")
 
     flash(f'Scanned {scanned} folders. Created {created} manga rows.', 'success')
     return redirect(url_for('content_dashboard') if is_admin(user) else url_for('index'))
@@ -795,15 +3203,6 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-dbconfig = {
-    "host": "127.0.0.1",
-    "user": "root",
-    "password": "",
-    "database": "mangaforall"
-}
-
-POOL = pooling.MySQLConnectionPool(pool_name="mypool", pool_size=5, **dbconfig)
-
 def get_all_posts():
     conn = POOL.get_connection()
     cur = conn.cursor(dictionary=True)
@@ -824,7 +3223,8 @@ def forum():
             f.post_id,
             f.title,
             f.content,
-            f.image,
+            f.image_path,
+            (f.image IS NOT NULL) AS image,
             u.user_id   AS author_id,
             u.username  AS author
         FROM forum_posts f
@@ -851,7 +3251,7 @@ def forum():
         GROUP BY u.user_id, u.username
         ORDER BY total_contributions DESC
         LIMIT 10
-    """)
+    """, cache_tables=("forum_posts", "forum_comments"))
 
     comments_by_post = {}
     if posts:
@@ -878,7 +3278,52 @@ def forum():
                            posts=posts,
                            comments_by_post=comments_by_post,
                            top_contributors=top_contributors,
-                           user=current_user())
+                           shared_page=True)
+
+# forum images are stored on disk under a content hash; forum_posts.image_path points at them
+FORUM_IMAGE_FOLDER = os.path.join(app.static_folder, "uploads")
+FORUM_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+FORUM_IMAGE_MIMES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+UPLOAD_CHUNK = 64 * 1024
+
+class UploadRejected(Exception):
+    pass
+
+def save_upload_streaming(file, dest_dir, max_bytes=FORUM_IMAGE_MAX_BYTES, allowed_mimes=FORUM_IMAGE_MIMES):
+    """
+    Copy an uploaded file to dest_dir in UPLOAD_CHUNK pieces. The type is sniffed from
+    the first chunk's magic bytes (not the client's mimetype), the sha256 is computed
+    while copying and the copy aborts as soon as max_bytes is passed.
+    Returns (filename, mime); raises UploadRejected with a user-facing message.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    kind = None
+    fd, tmp = tempfile.mkstemp(dir=dest_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                if kind is None:
+                    kind = filetype.guess(chunk)
+                    if not kind or kind.mime not in allowed_mimes:
+                        raise UploadRejected("Only PNG, JPEG, GIF or WebP images are allowed.")
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadRejected(f"Images must be under {max_bytes // (1024 * 1024)} MB.")
+                digest.update(chunk)
+                out.write(chunk)
+        if kind is None:
+            raise UploadRejected("The uploaded file is empty.")
+        name = f"{digest.hexdigest()}.{kind.extension}"
+        os.replace(tmp, os.path.join(dest_dir, name))
+        return name, kind.mime
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
 
 @app.route("/forum/new", methods=["GET", "POST"])
 @login_required
@@ -892,28 +3337,30 @@ def new_post():
         content = request.form["content"].strip()
         author  = u["username"]
 
-        image_bytes = None
-        image_mime  = None
+        image_path = None
+        image_mime = None
         file = request.files.get("image")
         if file and file.filename:
-            if not (file.mimetype or "").startswith("image/"):
-                flash("Only image files are allowed.", "warning")
+            try:
+                fname, image_mime = save_upload_streaming(file, FORUM_IMAGE_FOLDER)
+            except UploadRejected as e:
+                flash(str(e), "warning")
                 return redirect(url_for("new_post"))
-            image_bytes = file.read()
-            image_mime  = file.mimetype
+            image_path = f"uploads/{fname}"
 
         execute(
             """
-            INSERT INTO forum_posts (title, content, author, image, image_mime, user_id, admin_id)
+            INSERT INTO forum_posts (title, content, author, image_path, image_mime, user_id, admin_id)
             VALUES (%s, %s, %s, %s, %s, %s, %s)
             """,
             (
                 title, content, author,
-                image_bytes, image_mime,
+                image_path, image_mime,
                 u["user_id"],
                 u["admin_id"] if is_admin(u) else None,
             ),
         )
+        invalidate("forum")
         flash("Post created!", "success")
         return redirect(url_for("forum"))
     return render_template("new_post.html", user=u)
@@ -925,8 +3372,9 @@ def post_detail(post_id):
         abort(404)
 
 
+    is_partial = bool(request.args.get("partial") or request.headers.get("X-Requested-With") == "fetch")
+
     def render_partial_or_full():
-        is_partial = request.args.get("partial") or request.headers.get("X-Requested-With") == "fetch"
         template = "post_detail_modal.html" if is_partial else "post_detail.html"
         comments = query_all(
             """
@@ -970,18 +3418,45 @@ def post_detail(post_id):
             "INSERT INTO forum_comments (content, user_id, post_id, admin_id) VALUES (%s, %s, %s, %s)",
             (content, u["user_id"], post_id, u["admin_id"] if is_admin(u) else None)
         )
+        invalidate(f"post:{post_id}", "forum")
 
 
         if request.args.get("partial") or request.headers.get("X-Requested-With") == "fetch":
             return render_partial_or_full()
         return redirect(url_for("post_detail", post_id=post_id))
-    return render_partial_or_full()
+
+    # the thread changes only by comments being added or deleted; moderators also see the author's ban state
+    viewer = viewer_key()
+    last = query_one("SELECT COUNT(*) AS n, COALESCE(MAX(comment_id), 0) AS last_id "
+                     "FROM forum_comments WHERE post_id=%s", (post_id,))
+    version = tag_version(f"post:{post_id}")
+    etag = None if version is None else entity_etag(  # no ETag while the version is unknown
+        "post", post_id, is_partial, last["n"], last["last_id"], version, viewer,
+        viewer and viewer[2] and post.get("user_id") and user_id_is_banned(post["user_id"]))
+    unchanged = not_modified(etag, private=True)
+    if unchanged is not None:
+        return unchanged
+    return with_etag(render_partial_or_full(), etag, private=True)
 
 
 
 
 @app.route("/post_image/<int:post_id>", endpoint="post_image_blob")
 def post_image(post_id):
+    row = query_one(
+        "SELECT image_path, image_mime FROM forum_posts WHERE post_id=%s",
+        (post_id,),
+    )
+    if row and row.get("image_path"):
+        fs_path = os.path.join(app.static_folder, row["image_path"].replace("/", os.sep))
+        if not os.path.isfile(fs_path):
+            abort(404)
+        # file names are content hashes, so they never change
+        resp = send_path(fs_path, mimetype=row.get("image_mime") or None)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+    # older posts keep the image bytes in the row itself
     row = query_one(
         "SELECT image, image_mime FROM forum_posts WHERE post_id=%s",
         (post_id,),
@@ -1010,6 +3485,7 @@ def add_comment(post_id):
         "INSERT INTO forum_comments (content, user_id, post_id, admin_id) VALUES (%s, %s, %s, %s)",
         (content, user["user_id"], post_id, user["admin_id"] if is_admin(user) else None)
     )
+    invalidate(f"post:{post_id}", "forum")
     flash("Comment added!", "success")
     return redirect(url_for('forum'))
 
@@ -1053,6 +3529,7 @@ def mod_delete_post(post_id):
         return redirect(url_for("forum"))
     execute("DELETE FROM forum_comments WHERE post_id=%s", (post_id,))
     execute("DELETE FROM forum_posts WHERE post_id=%s", (post_id,))
+    invalidate(f"post:{post_id}", "forum")
     flash("Post deleted.", "success")
     return redirect(url_for("forum"))
 
@@ -1064,10 +3541,121 @@ def mod_delete_post(post_id):
 AVATAR_FOLDER = os.path.join(app.static_folder, "avatars")
 os.makedirs(AVATAR_FOLDER, exist_ok=True)
 ALLOWED_AVATAR_EXTS = {"png", "jpg", "jpeg", "gif", "webp"}
+# every upload is stored as one square WebP per size; users.Profile_pic points at the largest
+AVATAR_SIZES = (48, 96, 256)
+AVATAR_MAX_PIXELS = 40_000_000  # refuse decompression bombs before decoding
+AVATAR_RE = re.compile(r"^user_(\d+)_(\d+)(?:_(\d+))?\.(\w+)$")
+
+# resizing/encoding happens here, not on the request thread
+_avatar_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="avatar")
 
 def _allowed_avatar(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_AVATAR_EXTS
 
+def _avatar_name(uid, ts, size):
+    return f"user_{uid}_{ts}_{size}.webp"
+
+def _decode_avatar(data: bytes):
+    """Decode the upload once; returns an RGBA image or None if it isn't a real image."""
+    try:
+        img = Image.open(BytesIO(data))
+        if img.width * img.height > AVATAR_MAX_PIXELS:
+            return None
+        img.seek(0)  # first frame only for animated GIF/WEBP
+        img.load()
+    except Exception:
+        return None
+    img = ImageOps.exif_transpose(img)
+    return img.convert("RGBA")
+
+def _avatar_ts(name):
+    """Upload timestamp encoded in a processed avatar's file name, 0 for legacy names."""
+    m = AVATAR_RE.match(os.path.basename(name))
+    return int(m.group(2)) if m and m.group(3) else 0
+
+def _remove_old_avatars(uid, before):
+    """Delete this user's avatar files uploaded before `before`. Returns bytes freed.
+
+    Newer sets and in-flight .tmp files are left alone, so a slow job can never
+    delete what a later upload installed."""
+    freed = 0
+    for path in glob.glob(os.path.join(AVATAR_FOLDER, f"user_{uid}_*")) + \
+                glob.glob(os.path.join(AVATAR_FOLDER, f"user_{uid}.*")):
+        name = os.path.basename(path)
+        m = AVATAR_RE.match(name)
+        legacy = name.startswith(f"user_{uid}.")
+        if not legacy and not (m and m.group(1) == str(uid) and _avatar_ts(name) < before):
+            continue
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    return freed
+
+# one job at a time per user, in upload order; the conditional UPDATE below covers other workers
+_avatar_locks = {}
+_avatar_locks_guard = threading.Lock()
+
+def _avatar_lock(uid):
+    with _avatar_locks_guard:
+        return _avatar_locks.setdefault(uid, threading.Lock())
+
+def _process_avatar(uid, ts, img):
+    """Background job: crop square, write every size as WebP, point the DB at it, drop old files."""
+    try:
+        with _avatar_lock(uid):
+            side = min(img.width, img.height)
+            left, top = (img.width - side) // 2, (img.height - side) // 2
+            square = img.crop((left, top, left + side, top + side))
+            names = []
+            for size in AVATAR_SIZES:
+                name = _avatar_name(uid, ts, size)
+                out = square.resize((size, size), Image.LANCZOS) if side > size else square
+                tmp = os.path.join(AVATAR_FOLDER, f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                out.save(tmp, "WEBP", quality=85, method=4)
+                os.replace(tmp, os.path.join(AVATAR_FOLDER, name))
+                names.append(name)
+
+            rel_path = f"avatars/{names[-1]}"
+            # never move the pointer back to an older upload (avatars/user_<uid>_<ts>_<size>.webp)
+            execute(
+                "UPDATE users SET Profile_pic=%s WHERE user_id=%s AND (Profile_pic IS NULL OR "
+                "CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(Profile_pic, '_', -2), '_', 1) AS UNSIGNED) <= %s)",
+                (rel_path, uid, ts))
+            row = query_one("SELECT Profile_pic FROM users WHERE user_id=%s", (uid,))
+            current = row and row["Profile_pic"]
+            if isinstance(current, (bytes, bytearray)):
+                current = bytes(current).decode("utf-8", errors="ignore")
+            if current != rel_path and _avatar_ts(current or "") > ts:
+                # a later upload got there first: this set is already stale
+                for name in names:
+                    try:
+                        os.remove(os.path.join(AVATAR_FOLDER, name))
+                    except OSError:
+                        pass
+                return
+            # only after the DB points at the new set is it safe to drop the older ones
+            _remove_old_avatars(uid, before=ts)
+    except Exception:
+        app.logger.exception("Avatar processing failed for user %s", uid)
+
+def _avatar_fs_path(path_str):
+    path_str = path_str.strip().strip("\x00").strip("'").strip('"')
+    if path_str.startswith("static/"):
+        return os.path.join(app.root_path, path_str.replace("/", os.sep))
+    return os.path.join(app.static_folder, path_str.replace("/", os.sep))
+
+def _avatar_size_variant(fs_path, size):
+    """Swap the size suffix of a processed avatar for the smallest stored size >= `size`."""
+    m = AVATAR_RE.match(os.path.basename(fs_path))
+    if not size or not m or not m.group(3):
+        return fs_path
+    want = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+    candidate = os.path.join(os.path.dirname(fs_path), _avatar_name(m.group(1), m.group(2), want))
+    return candidate if os.path.isfile(candidate) else fs_path
+
 @app.post("/profile/avatar")
 @login_required
 def upload_avatar():
@@ -1080,31 +3668,50 @@ def upload_avatar():
         flash("Unsupported image type. Use PNG/JPG/GIF/WEBP.", "danger")
         return redirect(url_for("profile"))
 
+    img = _decode_avatar(file.read())
+    if img is None:
+        flash("That file is not a valid image.", "danger")
+        return redirect(url_for("profile"))
+
     u = current_user()
     uid = u["user_id"]
-
-    # remove any previous avatar files 
-    for old in glob.glob(os.path.join(AVATAR_FOLDER, f"user_{uid}.*")):
-        try: os.remove(old)
-        except OSError: pass
-
-    ts  = int(time.time())
-    ext = file.filename.rsplit(".", 1)[1].lower()
-    fname = f"user_{uid}_{ts}.{ext}"
-    save_fs = os.path.join(AVATAR_FOLDER, fname)
-    file.save(save_fs)
-
-    # store RELATIVE path ONLY 
-    rel_path = f"avatars/{fname}"
-
-    # write to DB using  helper 
-    execute("UPDATE users SET Profile_pic=%s WHERE user_id=%s", (rel_path, uid))
+    ts  = time.time_ns() // 1000  # microseconds: two uploads in the same second get distinct names
+    _avatar_pool.submit(_process_avatar, uid, ts, img)
 
     session["avatar_ver"] = ts
 
     flash("Profile picture updated!", "success")
     return redirect(url_for("profile"))
 
+@app.cli.command("sweep-avatars")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted.")
+def sweep_avatars(dry_run):
+    """Delete avatar files no user points at any more and report the bytes freed."""
+    keep = set()
+    for row in query_all("SELECT user_id, Profile_pic FROM users WHERE Profile_pic IS NOT NULL"):
+        pic = row["Profile_pic"]
+        if isinstance(pic, (bytes, bytearray)):
+            if filetype.guess(bytes(pic)):
+                continue  # image stored inline, nothing on disk
+            pic = bytes(pic).decode("utf-8", errors="ignore")
+        name = os.path.basename(pic.strip().strip("\x00").strip("'").strip('"'))
+        m = AVATAR_RE.match(name)
+        if m and m.group(3):
+            keep.update(_avatar_name(m.group(1), m.group(2), s) for s in AVATAR_SIZES)
+        else:
+            keep.add(name)
+
+    files, freed = 0, 0
+    for name in sorted(os.listdir(AVATAR_FOLDER)):
+        path = os.path.join(AVATAR_FOLDER, name)
+        if not name.startswith("user") or name in keep or not os.path.isfile(path):
+            continue
+        files += 1
+        freed += os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+    verb = "Would free" if dry_run else "Freed"
+    click.echo(f"{verb} {freed} bytes from {files} orphaned avatar files.")
 
 # ...
 
@@ -1116,7 +3723,9 @@ def user_avatar(uid: int):
     1) users.Profile_pic is IMAGE BYTES (BLOB of the actual image)
     2) users.Profile_pic is BYTES of a PATH STRING (BLOB containing e.g. b'avatars/user_1_123.jpg')
     3) users.Profile_pic is a STRING path ('avatars/user_1_123.jpg')
+    `?s=48` picks the closest pre-resized WebP for processed uploads.
     """
+    size = request.args.get("s", type=int)
     row = query_one("SELECT username, Profile_pic FROM users WHERE user_id=%s", (uid,))
     username = (row.get("username") if row else "U") or "U"
     pic = row.get("Profile_pic") if row else None
@@ -1124,7 +3733,7 @@ def user_avatar(uid: int):
     def serve_file(fs_path):
         if os.path.isfile(fs_path):
             mt = mimetypes.guess_type(fs_path)[0] or "image/jpeg"
-            resp = send_file(fs_path, mimetype=mt, conditional=True)
+            resp = send_path(fs_path, mimetype=mt)
             resp.headers["Cache-Control"] = "no-store"
             return resp
         return None
@@ -1142,22 +3751,11 @@ def user_avatar(uid: int):
             path_str = None
 
         if path_str:
-            fs_path = (
-                os.path.join(app.static_folder, path_str.replace("/", os.sep))
-                if not path_str.startswith("static/")
-                else os.path.join(app.root_path, path_str.replace("/", os.sep))
-            )
-            served = serve_file(fs_path)
+            served = serve_file(_avatar_size_variant(_avatar_fs_path(path_str), size))
             if served:
                 return served
     if isinstance(pic, str) and pic:
-        path_str = pic.strip().strip("\x00").strip("'").strip('"')
-        fs_path = (
-            os.path.join(app.static_folder, path_str.replace("/", os.sep))
-            if not path_str.startswith("static/")
-            else os.path.join(app.root_path, path_str.replace("/", os.sep))
-        )
-        served = serve_file(fs_path)
+        served = serve_file(_avatar_size_variant(_avatar_fs_path(pic), size))
         if served:
             return served
 
@@ -1208,6 +3806,7 @@ def wishlist_toggle(manga_id):
     else:
         execute("INSERT INTO wishlist (user_id, manga_id, added_at) VALUES (%s, %s, NOW())",
                 (u["user_id"], manga_id))
+    invalidate(f"user:{u['user_id']}")
 
     return redirect(url_for("manga_detail", manga_id=manga_id))
 # --------------valid_email-------------#
@@ -1308,12 +3907,20 @@ def user_card(uid: int):
     if not u:
         abort(404)
 
+    is_partial = bool(request.args.get("partial")
+                      or request.headers.get("X-Requested-With") == "fetch")
+    # profile row + favourites version (bumped by wishlist_toggle) + the titles they point at
+    versions = (tag_version(f"user:{uid}"), tag_version("table:manga"))
+    etag = None if None in versions else entity_etag("user", sorted(u.items()), is_partial, versions, viewer_key())
+    unchanged = not_modified(etag, private=True)
+    if unchanged is not None:
+        return unchanged
+
     # Favorites 
     favorites = user_favorites(uid)
-    is_partial = (request.args.get("partial")
-                  or request.headers.get("X-Requested-With") == "fetch")
     template = "user_card_modal.html" if is_partial else "user_public.html"
-    return render_template(template, profile=u, favorites=favorites, viewer=current_user())
+    return with_etag(render_template(template, profile=u, favorites=favorites, viewer=current_user()),
+                     etag, private=True)
 
 #########============================######
 
@@ -42,7 +42,8 @@
     e.preventDefault();
     const url = a.getAttribute('href');
     const fetchUrl = url + (url.includes('?') ? '&' : '?') + 'partial=1';
-    const res = await fetch(fetchUrl, { headers: { 'X-Requested-With': 'fetch' } });
+    // revalidate the browser's copy: an unchanged post/card comes back as a bodiless 304
+    const res = await fetch(fetchUrl, { cache: 'no-cache', headers: { 'X-Requested-With': 'fetch' } });
     show(await res.text(), url);
     // focus first focusable
     const first = contentEl.querySelector('button, [href], input, textarea, select, [tabindex]:not([tabindex="-1"])');
@@ -77,6 +78,42 @@
     }
   });
 })();
+// ===== Shared pages: fill the personal bits (nav, favourite, resume) from /me =====
+(function () {
+  const meUrl = document.body.dataset.me;
+  if (!meUrl) return;
+  const url = new URL(meUrl, location.href);
+  const scope = document.querySelector('[data-me-manga]');
+  if (scope) {
+    url.searchParams.set('manga', scope.dataset.meManga);
+    if (scope.dataset.meFolder) url.searchParams.set('folder', scope.dataset.meFolder);
+  }
+
+  fetch(url, { credentials: 'same-origin', headers: { 'Accept': 'application/json' } })
+    .then(r => r.ok ? r.json() : null)
+    .then(me => {
+      if (!me) return;
+      const u = me.user;
+      const show = { user: !!u, anon: !u, content: !!(u && u.content_manager) };
+      document.querySelectorAll('[data-me-show]').forEach(el => {
+        el.classList.toggle('hidden', !show[el.dataset.meShow]);
+      });
+
+      const fav = document.querySelector('[data-me-fav]');
+      if (fav && me.favorited) {
+        fav.textContent = '★ Favorited — Remove';
+        fav.classList.add('outline');
+      }
+      const resume = document.querySelector('[data-me-resume]');
+      if (resume && me.resume) {
+        resume.href = me.resume.url;
+        resume.textContent = `Continue ${me.resume.chapter} · page ${me.resume.page + 1}`;
+        resume.classList.remove('hidden');
+      }
+    })
+    .catch(() => {});
+})();
+
 // ----- Modal controls (robust) -----
 (function () {
   const $ = (s, r = document) => r.querySelector(s);
@@ -264,8 +301,8 @@
   const pagesWrap = document.getElementById('popout-pages');
   if (!scroller || !pagesWrap) { console.warn('[popout] missing #popout-scroll/#popout-pages'); return; }
 
-  const nextChUrl = el.dataset.nextChUrl || '';
-  const prevChUrl = el.dataset.prevChUrl || '';
+  let nextChUrl = el.dataset.nextChUrl || '';
+  let prevChUrl = el.dataset.prevChUrl || '';
 
   let pages = Array.isArray(window.READER_PAGES) ? window.READER_PAGES.slice() : [];
   let idx   = Number.isInteger(window.READER_INDEX) ? window.READER_INDEX : 0;
@@ -293,8 +330,10 @@
       empty.textContent = 'No pages in this chapter.';
       frag.appendChild(empty);
     } else {
+      const dims = Array.isArray(window.READER_DIMS) ? window.READER_DIMS : [];
       pages.forEach((src, i) => {
         const im = document.createElement('img');
+        if (dims[i] && dims[i][0]) { im.width = dims[i][0]; im.height = dims[i][1]; }
         im.src = src;
         im.alt = `page ${i + 1}`;
         im.decoding = 'async';
@@ -401,8 +440,9 @@
   btnClose  && btnClose.addEventListener('click', hide);
 
   // chapter-only navigation on buttons and arrows
-  function jumpPrevChapter(){ if (prevChUrl) location.href = prevChUrl; }
-  function jumpNextChapter(){ if (nextChUrl) location.href = nextChUrl; }
+  // in-place switch when the reader module is active, full navigation otherwise
+  function jumpPrevChapter(){ if (window.MFAReader && window.MFAReader.go('prev')) return; if (prevChUrl) location.href = prevChUrl; }
+  function jumpNextChapter(){ if (window.MFAReader && window.MFAReader.go('next')) return; if (nextChUrl) location.href = nextChUrl; }
   btnPrev && btnPrev.addEventListener('click', jumpPrevChapter);
   btnNext && btnNext.addEventListener('click', jumpNextChapter);
 
@@ -422,25 +462,256 @@
     applyRect();
   });
 
-  // optional: keep popout in sync with main scroll when open
-  const pageImgs = Array.from(document.querySelectorAll('.page-img'));
-  function syncFromMain(){
-    if (!pageImgs.length) return;
-    let best = 0, bestDist = Infinity;
-    const y = window.scrollY + window.innerHeight * 0.35;
-    pageImgs.forEach((im, i) => {
-      const rect = im.getBoundingClientRect();
-      const center = rect.top + window.scrollY + rect.height/2;
-      const d = Math.abs(center - y);
-      if (d < bestDist) { best = i; bestDist = d; }
+  // keep popout in sync with the main reader: the observer's root is shrunk to a thin band
+  // 35% down the viewport, so it only fires when a page crosses that line (no scroll handler)
+  let mainIo = null;
+  function observeMain(){
+    if (!('IntersectionObserver' in window)) return;
+    if (mainIo) mainIo.disconnect();
+    mainIo = new IntersectionObserver(entries => {
+      for (const e of entries) {
+        if (!e.isIntersecting) continue;
+        const i = Number(e.target.dataset.index);
+        if (i !== idx) { idx = i; if (!el.classList.contains('popout-hidden')) scrollToIndex(idx, true); }
+      }
+    }, { rootMargin: '-35% 0px -64% 0px' });
+    document.querySelectorAll('#reader-pages > [data-index]').forEach(p => mainIo.observe(p));
+  }
+  observeMain();
+
+  // chapter swapped in place: take over the new page list and chapter links
+  document.addEventListener('reader:chapter', e => {
+    const d = e.detail;
+    pages = (window.READER_PAGES || []).slice();
+    idx = 0;
+    built = false;
+    prevChUrl = d.prev ? d.prev.url : '';
+    nextChUrl = d.next ? d.next.url : '';
+    const t = el.querySelector('.popout-title');
+    if (t) t.textContent = d.title;
+    if (!el.classList.contains('popout-hidden')) { buildPages(); scrollToIndex(0, true); watchVisibility(); }
+    observeMain();
+  });
+
+  console.log('[popout] ready');
+})();
+// ===== Virtualised reader: only pages near the viewport keep an <img> =====
+(function () {
+  const wrap = document.getElementById('reader-pages');
+  if (!wrap || !('IntersectionObserver' in window)) return;
+
+  function attach(slot){
+    if (slot.firstChild) return;
+    const i = Number(slot.dataset.index);
+    const pages   = window.READER_PAGES || [];
+    const srcsets = window.READER_SRCSETS || [];
+    const dims    = window.READER_DIMS || [];
+    const im = document.createElement('img');
+    im.className = 'page-img';
+    im.decoding = 'async';
+    im.alt = `page ${i + 1}`;
+    if (dims[i] && dims[i][0]) { im.width = dims[i][0]; im.height = dims[i][1]; }
+    if (srcsets[i]) { im.srcset = srcsets[i]; im.sizes = wrap.dataset.sizes || ''; }
+    im.src = pages[i];
+    slot.appendChild(im);
+  }
+  function detach(slot){ slot.replaceChildren(); }
+
+  // slots keep their aspect-ratio box while empty, so attaching/detaching never shifts layout
+  const io = new IntersectionObserver(entries => {
+    entries.forEach(e => e.isIntersecting ? attach(e.target) : detach(e.target));
+  }, { rootMargin: '150% 0px' });
+  function setup(){
+    io.disconnect();
+    if (wrap.classList.contains('is-virtual')) wrap.querySelectorAll('.page-slot').forEach(s => io.observe(s));
+  }
+  setup();
+  document.addEventListener('reader:chapter', setup);
+})();
+// ===== Next-chapter prefetch: warm the next chapter while the reader nears the end =====
+(function () {
+  const wrap = document.getElementById('reader-pages');
+  if (!wrap || !('IntersectionObserver' in window)) return;
+
+  let next = null;
+  const io = new IntersectionObserver(entries => {
+    if (!next || !entries.some(e => e.isIntersecting)) return;
+    io.disconnect();
+    // Purpose: prefetch keeps this out of the chapters-read count; the real switch revalidates by ETag
+    fetch(next.api, { headers: { 'Accept': 'application/json', 'Purpose': 'prefetch' } }).catch(() => {});
+    (next.pages || []).forEach(p => {
+      const im = new Image();
+      if (p.srcset) { im.sizes = wrap.dataset.sizes || ''; im.srcset = p.srcset; }
+      im.src = p.src;
     });
-    if (best !== idx) { idx = best; if (!el.classList.contains('popout-hidden')) scrollToIndex(idx, true); }
+  }, { rootMargin: '200% 0px' });
+
+  function setup(){
+    io.disconnect();
+    next = window.READER_DATA && window.READER_DATA.next;
+    if (!next) return;
+    Array.from(wrap.querySelectorAll('[data-index]')).slice(-3).forEach(t => io.observe(t));
   }
-  if (pageImgs.length) {
-    window.addEventListener('scroll', () => { if (!el.classList.contains('popout-hidden')) syncFromMain(); }, { passive: true });
+  setup();
+  document.addEventListener('reader:chapter', setup);
+})();
+// ===== Reader: switch chapters in place through /api/reader (no full page reload) =====
+(function () {
+  const wrap = document.getElementById('reader-pages');
+  let data = window.READER_DATA;
+  if (!wrap || !data || !window.fetch || !history.pushState) return;
+
+  // an explicit ?virtual= choice sticks across chapters
+  const forced = new URLSearchParams(location.search).get('virtual');
+  const withMode = u => forced ? `${u}?virtual=${forced}` : u;
+
+  function renderPages(){
+    wrap.classList.toggle('is-virtual', !!data.virtual);
+    const frag = document.createDocumentFragment();
+    data.pages.forEach((p, i) => {
+      let node;
+      if (data.virtual) {
+        node = document.createElement('div');
+        node.className = 'page-slot';
+        node.style.aspectRatio = `${p.w || 2} / ${p.h || 3}`;
+      } else {
+        node = document.createElement('img');
+        node.className = 'page-img';
+        node.loading = 'lazy';
+        node.alt = `page ${i + 1}`;
+        if (p.w) { node.width = p.w; node.height = p.h; }
+        if (p.srcset) { node.sizes = data.sizes; node.srcset = p.srcset; }
+        node.src = p.src;
+      }
+      node.dataset.index = i;
+      frag.appendChild(node);
+    });
+    wrap.replaceChildren(frag);
   }
 
-  console.log('[popout] ready');
+  // mirrors reader.html: a link when the chapter exists, a disabled button otherwise
+  function setNav(id, target, label, primary){
+    const old = document.getElementById(id);
+    if (!old) return;
+    const node = document.createElement(target ? 'a' : 'button');
+    node.className = target && primary ? 'btn' : 'btn outline';
+    if (target) node.href = withMode(target.url); else node.disabled = true;
+    node.id = id;
+    node.textContent = label;
+    old.replaceWith(node);
+  }
+
+  function apply(next){
+    data = next;
+    window.READER_DATA = data;
+    window.READER_PAGES = data.pages.map(p => p.src);
+    window.READER_SRCSETS = data.pages.map(p => p.srcset);
+    window.READER_DIMS = data.pages.map(p => [p.w, p.h]);
+    window.READER_INDEX = 0;
+
+    document.title = `Reader · ${data.title}`;
+    const h1 = document.querySelector('.reader-wrap .page-title');
+    if (h1) h1.textContent = data.title;
+    const toggle = document.getElementById('virtual-toggle');
+    if (toggle) {
+      toggle.href = `${data.url}?virtual=${data.virtual ? 0 : 1}`;
+      toggle.textContent = data.virtual ? 'All pages' : 'Light mode';
+    }
+    setNav('prev-chapter-btn', data.prev, 'Prev', false);
+    setNav('prev-chapter-btn-bottom', data.prev, 'Prev', false);
+    setNav('next-chapter-btn', data.next, 'Next', true);
+    setNav('next-chapter-btn-bottom', data.next, 'Next', true);
+
+    renderPages();
+    window.scrollTo(0, 0);
+    document.dispatchEvent(new CustomEvent('reader:chapter', { detail: data }));
+  }
+
+  let busy = false;
+  async function load(target, push){
+    if (busy) return;
+    busy = true;
+    try {
+      const res = await fetch(withMode(target.api), { headers: { 'Accept': 'application/json' } });
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
+      const next = await res.json();
+      if (!next.pages.length) throw new Error('empty chapter');
+      apply(next);
+      if (push) history.pushState({ reader: true, api: next.api, url: next.url }, '', withMode(next.url));
+    } catch (err) {
+      console.warn('[reader] in-place switch failed, loading page', err);
+      location.href = withMode(target.url);
+    } finally {
+      busy = false;
+    }
+  }
+
+  function go(dir){
+    const target = data[dir];
+    if (!target) return false;
+    load(target, true);
+    return true;
+  }
+  window.MFAReader = { go };
+
+  history.replaceState({ reader: true, api: data.api, url: data.url }, '', location.href);
+
+  document.addEventListener('click', e => {
+    const a = e.target.closest('a#prev-chapter-btn, a#prev-chapter-btn-bottom, a#next-chapter-btn, a#next-chapter-btn-bottom');
+    if (!a || e.button !== 0 || e.metaKey || e.ctrlKey || e.shiftKey || e.altKey) return;
+    e.preventDefault();
+    go(a.id.startsWith('prev') ? 'prev' : 'next');
+  });
+
+  window.addEventListener('popstate', e => {
+    const st = e.state;
+    if (st && st.reader && st.api !== data.api) load(st, false);
+  });
+})();
+// ===== Reading progress: report the current page with sendBeacon =====
+(function () {
+  const wrap = document.getElementById('reader-pages');
+  const url = window.READER_PROGRESS_URL;
+  if (!wrap) return;
+
+  // resume position: /reader/<folder>/<chapter>#p=12 (1-based)
+  const m = location.hash.match(/^#p=(\d+)$/);
+  if (m) {
+    const target = wrap.querySelector(`[data-index="${Number(m[1]) - 1}"]`);
+    if (target) target.scrollIntoView();
+  }
+
+  if (!url || !navigator.sendBeacon || !('IntersectionObserver' in window)) return;
+
+  let cur = window.READER_DATA, page = 0, sent = null;
+  function send(){
+    if (!cur) return;
+    const key = `${cur.chapter}:${page}`;
+    if (key === sent) return;
+    const body = new FormData();
+    body.append('folder', cur.folder);
+    body.append('chapter', cur.chapter);
+    body.append('page', page);
+    navigator.sendBeacon(url, body);
+    sent = key;
+  }
+
+  const io = new IntersectionObserver(entries => {
+    for (const e of entries) if (e.isIntersecting) page = Number(e.target.dataset.index);
+  }, { rootMargin: '-35% 0px -64% 0px' });
+  function observe(){ io.disconnect(); wrap.querySelectorAll('[data-index]').forEach(p => io.observe(p)); }
+  observe();
+
+  setInterval(send, 15000);
+  document.addEventListener('visibilitychange', () => { if (document.visibilityState === 'hidden') send(); });
+  window.addEventListener('pagehide', send);
+  document.addEventListener('reader:chapter', e => {
+    send();  // last page of the chapter we're leaving
+    cur = e.detail;
+    page = 0;
+    sent = `${cur.chapter}:0`;  // the chapter API already recorded page 0
+    observe();
+  });
 })();
 // Avatar click-to-upload
 (function () {
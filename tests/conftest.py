@@ -0,0 +1,25 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+from mysql.connector import pooling
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    """app.py imported without a MySQL server: the pool is created at import time, so it is faked here
+    and tests replace the query helpers they need."""
+    os.environ.setdefault("CACHE_URL", "memory://")
+    cwd = os.getcwd()
+    os.chdir(ROOT)  # app.py creates its relative upload folder on import
+    try:
+        with mock.patch.object(pooling, "MySQLConnectionPool"):
+            import app
+    finally:
+        os.chdir(cwd)
+    app.app.config["TESTING"] = True
+    return app
@@ -0,0 +1,50 @@
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def avatars(app_module, monkeypatch, tmp_path):
+    """users.Profile_pic for one user; execute() applies the conditional UPDATE like MySQL would."""
+    row = {"Profile_pic": None}
+
+    def execute(sql, params=()):
+        rel_path, uid, ts = params
+        if row["Profile_pic"] is None or app_module._avatar_ts(row["Profile_pic"]) <= ts:
+            row["Profile_pic"] = rel_path
+
+    monkeypatch.setattr(app_module, "AVATAR_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app_module, "execute", execute)
+    monkeypatch.setattr(app_module, "query_one", lambda sql, params=(): dict(row))
+    return app_module, row, tmp_path
+
+
+def _files(folder):
+    return sorted(p.name for p in folder.iterdir())
+
+
+def test_older_job_finishing_last_keeps_the_newer_avatar(avatars):
+    app_module, row, folder = avatars
+    img = Image.new("RGBA", (300, 300), "red")
+    older, newer = 1_700_000_000_000_000, 1_700_000_000_000_001  # same second, distinct names
+
+    app_module._process_avatar(7, newer, img)
+    app_module._process_avatar(7, older, img)  # e.g. the other pool thread was slower
+
+    assert row["Profile_pic"] == f"avatars/user_7_{newer}_256.webp"
+    assert _files(folder) == sorted(app_module._avatar_name(7, newer, s) for s in app_module.AVATAR_SIZES)
+
+
+def test_new_upload_drops_only_older_files(avatars):
+    app_module, row, folder = avatars
+    (folder / "user_7.png").write_bytes(b"legacy")
+    (folder / "user_7_1_256.webp.99.1.tmp").write_bytes(b"in flight")
+    (folder / "user_77_1_256.webp").write_bytes(b"someone else")
+    img = Image.new("RGBA", (64, 64), "blue")
+
+    app_module._process_avatar(7, 10, img)
+    app_module._process_avatar(7, 20, img)
+
+    assert row["Profile_pic"] == "avatars/user_7_20_256.webp"
+    assert _files(folder) == sorted(
+        ["user_7_1_256.webp.99.1.tmp", "user_77_1_256.webp"] +
+        [app_module._avatar_name(7, 20, s) for s in app_module.AVATAR_SIZES])
@@ -0,0 +1,75 @@
+import pytest
+
+
+class FakeDB:
+    """Just enough of a connection for query_all/execute: one manga row whose title can be updated."""
+
+    def __init__(self):
+        self.title = "Old"
+        self.reads = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, dictionary=False):
+        return self
+
+    def execute(self, sql, params=()):
+        if sql.startswith("UPDATE"):
+            self.title = params[0]
+        else:
+            self.reads += 1
+        self.lastrowid = None
+
+    def fetchall(self):
+        return [{"Title": self.title}]
+
+    def commit(self):
+        pass
+
+
+class DownBackend:
+    """A shared tier in its back-off window: every call fails at once."""
+
+    def __init__(self, error):
+        self.error = error
+
+    def __getattr__(self, name):
+        def fail(*a, **k):
+            raise self.error("down")
+        return fail
+
+
+@pytest.fixture
+def outage(app_module, monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(app_module, "get_conn", lambda: db)
+    down = DownBackend(app_module.CacheUnavailable)
+    monkeypatch.setattr(app_module, "shared_cache", down)
+    monkeypatch.setattr(app_module.query_cache, "shared", down)
+    monkeypatch.setattr(app_module.cache, "shared", down)
+    app_module.sync_cache_generation()  # fails, which drops the memoised versions
+    return app_module, db
+
+
+def test_writes_stay_visible_while_the_shared_tier_is_down(outage):
+    app_module, db = outage
+    sql = "SELECT Title FROM manga WHERE manga_id=%s"
+
+    assert app_module.query_one(sql, (1,), cache_tables=("manga",))["Title"] == "Old"
+    app_module.execute("UPDATE manga SET Title=%s WHERE manga_id=%s", ("New", 1))
+    assert app_module.query_one(sql, (1,), cache_tables=("manga",))["Title"] == "New"
+    assert db.reads == 2  # nothing was served from (or stored in) the local tier
+
+
+def test_fragments_render_uncached_while_versions_are_unknown(outage):
+    app_module, _ = outage
+    assert app_module.fragment_key("cards", "catalog") is None
+    with app_module.app.app_context():
+        tmpl = app_module.app.jinja_env.from_string(
+            "{% cache fragment_key('cards', 'catalog') %}{{ n }}{% endcache %}")
+        assert tmpl.render(n=1) == "1"
+        assert tmpl.render(n=2) == "2"
@@ -0,0 +1,48 @@
+import io
+import os
+import zipfile
+
+import pytest
+from PIL import Image
+
+
+def _page(path, width, color):
+    Image.new("RGB", (width, 40), color).save(path, "PNG")
+
+
+@pytest.fixture
+def chapter(app_module, monkeypatch, tmp_path):
+    static = tmp_path / "static"
+    chapter_dir = static / "Resources" / "Series" / "Chapter 1"
+    chapter_dir.mkdir(parents=True)
+    for i, color in enumerate(("red", "green", "blue"), 1):
+        _page(chapter_dir / f"{i}.png", 30, color)
+    monkeypatch.setattr(app_module.app, "static_folder", str(static))
+    monkeypatch.setattr(app_module, "MANIFEST_DIR", str(tmp_path / "manifests"))
+    monkeypatch.setattr(app_module, "current_user", lambda: {"user_id": 1, "username": "tester", "admin_id": None})
+    return app_module, chapter_dir
+
+
+def _download(app_module):
+    resp = app_module.app.test_client().get("/download/Series/Chapter 1")
+    body = resp.get_data()
+    assert resp.status_code == 200
+    assert resp.content_length == len(body)
+    with zipfile.ZipFile(io.BytesIO(body)) as z:
+        assert z.testzip() is None
+        return {n: z.read(n) for n in z.namelist()}
+
+
+def test_page_replaced_in_place_refreshes_manifest(chapter):
+    app_module, chapter_dir = chapter
+    assert len(_download(app_module)) == 3
+
+    # overwrite a page with a bigger one and put the folder's mtime back: only the file changed
+    st = os.stat(chapter_dir)
+    _page(chapter_dir / "2.png", 300, "green")
+    os.utime(chapter_dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    pages = _download(app_module)
+    assert pages["0002.png"] == (chapter_dir / "2.png").read_bytes()
+    manifest = app_module.chapter_manifest("Series", "Chapter 1")
+    assert [p["w"] for p in manifest] == [30, 300, 30]
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+import tracemalloc
+
+import pytest
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def forum(app_module, monkeypatch, tmp_path):
+    """Logged-in, unbanned user; inserts are recorded instead of hitting MySQL."""
+    inserts = []
+    lock = threading.Lock()
+
+    def execute(sql, params=()):
+        with lock:
+            inserts.append(params)
+
+    monkeypatch.setattr(app_module, "current_user", lambda: {"user_id": 1, "username": "tester", "admin_id": None})
+    monkeypatch.setattr(app_module, "user_is_banned", lambda u: False)
+    monkeypatch.setattr(app_module, "execute", execute)
+    monkeypatch.setattr(app_module, "FORUM_IMAGE_FOLDER", str(tmp_path / "uploads"))
+    os.makedirs(app_module.FORUM_IMAGE_FOLDER)
+    return app_module, inserts
+
+
+def _image_file(tmp_path, name, size, head=PNG_MAGIC):
+    path = tmp_path / name
+    with open(path, "wb") as f:
+        f.write(head)
+        f.write(os.urandom(size - len(head)))
+    return path
+
+
+def _post(app_module, path, results, i):
+    client = app_module.app.test_client()
+    with open(path, "rb") as f:
+        resp = client.post("/forum/new", data={
+            "title": f"post {i}", "content": "hello", "image": (f, os.path.basename(path)),
+        }, content_type="multipart/form-data")
+    results[i] = resp
+
+
+def _post_concurrently(app_module, paths):
+    results = [None] * len(paths)
+    threads = [threading.Thread(target=_post, args=(app_module, p, results, i)) for i, p in enumerate(paths)]
+    tracemalloc.start()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return results, peak
+
+
+def test_concurrent_uploads_stream_to_disk(forum, tmp_path):
+    app_module, inserts = forum
+    paths = [_image_file(tmp_path, f"img{i}.png", 4 * MB) for i in range(6)]
+
+    results, peak = _post_concurrently(app_module, paths)
+
+    assert all(r.status_code == 302 and r.headers["Location"].endswith("/forum") for r in results)
+    # the test client keeps up to 500 KB of each request body in memory; under 1 MB per 4 MB upload
+    # means none of them was buffered whole on the server side
+    assert peak < len(paths) * MB, f"peak traced memory {peak / MB:.1f} MB"
+    stored = {p[3] for p in inserts}
+    expected = {f"uploads/{hashlib.sha256(p.read_bytes()).hexdigest()}.png" for p in paths}
+    assert stored == expected
+    for rel in expected:
+        stored_path = os.path.join(app_module.FORUM_IMAGE_FOLDER, os.path.basename(rel))
+        assert os.path.getsize(stored_path) == 4 * MB
+    assert not [n for n in os.listdir(app_module.FORUM_IMAGE_FOLDER) if n.endswith(".part")]
+
+
+def test_oversized_and_disguised_uploads_are_rejected(forum, tmp_path):
+    app_module, inserts = forum
+    too_big = _image_file(tmp_path, "big.png", app_module.FORUM_IMAGE_MAX_BYTES + MB)
+    not_image = _image_file(tmp_path, "fake.png", 64 * 1024, head=b"#!/bin/sh\necho hi\n")
+    paths = [too_big, not_image] * 3
+
+    results, peak = _post_concurrently(app_module, paths)
+
+    assert all(r.status_code == 302 and r.headers["Location"].endswith("/forum/new") for r in results)
+    assert peak < len(paths) * MB, f"peak traced memory {peak / MB:.1f} MB"
+    assert inserts == []
+    assert os.listdir(app_module.FORUM_IMAGE_FOLDER) == []
+
+
+def test_save_upload_streaming_messages(app_module, tmp_path):
+    class Upload:
+        def __init__(self, data):
+            import io
+            self.stream = io.BytesIO(data)
+
+    with pytest.raises(app_module.UploadRejected, match="under 1 MB"):
+        app_module.save_upload_streaming(Upload(PNG_MAGIC + bytes(2 * MB)), str(tmp_path), max_bytes=MB)
+    with pytest.raises(app_module.UploadRejected, match="Only PNG"):
+        app_module.save_upload_streaming(Upload(b"plain text, not an image"), str(tmp_path))
+    with pytest.raises(app_module.UploadRejected, match="empty"):
+        app_module.save_upload_streaming(Upload(b""), str(tmp_path))
+    assert os.listdir(tmp_path) == []
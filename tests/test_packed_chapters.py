@@ -0,0 +1,44 @@
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def chapter(app_module, monkeypatch, tmp_path):
+    static = tmp_path / "static"
+    chapter_dir = static / "Resources" / "Series" / "Chapter 1"
+    chapter_dir.mkdir(parents=True)
+    for i, color in enumerate(("red", "green", "blue"), 1):
+        Image.new("RGB", (30, 40), color).save(chapter_dir / f"{i}.png", "PNG")
+    monkeypatch.setattr(app_module.app, "static_folder", str(static))
+    monkeypatch.setattr(app_module, "MANIFEST_DIR", str(tmp_path / "manifests"))
+    return app_module, chapter_dir, static / "Resources" / "Series" / "Chapter 1.mfapack"
+
+
+def _pack_pages(app_module, pack_path):
+    pack = app_module.ChapterPack(str(pack_path))
+    return {n: bytes(pack.page_view(n)) for n in pack.pages}
+
+
+def test_repack_rewrites_the_pack_atomically(chapter):
+    app_module, chapter_dir, pack_path = chapter
+    assert app_module.pack_chapter(str(chapter_dir), str(pack_path)) > 0
+    first = pack_path.stat()
+
+    Image.new("RGB", (300, 40), "green").save(chapter_dir / "2.png", "PNG")
+    written = app_module.pack_chapter(str(chapter_dir), str(pack_path))
+
+    assert written == (chapter_dir / "2.png").stat().st_size  # only the changed page came from the folder
+    assert pack_path.stat().st_ino != first.st_ino           # a new file was swapped in
+    assert _pack_pages(app_module, pack_path) == {n: (chapter_dir / n).read_bytes() for n in ("1.png", "2.png", "3.png")}
+    assert [p.name for p in pack_path.parent.iterdir() if p.name.endswith(".tmp")] == []
+    assert app_module.pack_chapter(str(chapter_dir), str(pack_path)) == 0
+
+
+def test_damaged_pack_falls_back_to_the_loose_pages(chapter):
+    app_module, chapter_dir, pack_path = chapter
+    app_module.pack_chapter(str(chapter_dir), str(pack_path))
+    with open(pack_path, "ab") as f:
+        f.write(b"half-written page bytes")  # e.g. a writer from an older version that was interrupted
+
+    assert app_module.chapter_source("Series", "Chapter 1") == ("dir", str(chapter_dir))
+    assert [p["name"] for p in app_module.chapter_manifest("Series", "Chapter 1")] == ["1.png", "2.png", "3.png"]
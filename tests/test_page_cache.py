@@ -0,0 +1,39 @@
+import brotli
+import pytest
+
+
+@pytest.fixture
+def forum(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "query_all", lambda sql, params=(), cache_tables=None, ttl=None: [])
+    monkeypatch.setattr(app_module, "current_user", lambda: None)
+    monkeypatch.setattr(app_module, "COMPRESS_MIN_BYTES", 1)
+    app_module.invalidate("forum")
+    calls = []
+    compress_bytes = app_module.compress_bytes
+
+    def counting(data, encoding):
+        calls.append(encoding)
+        return compress_bytes(data, encoding)
+
+    monkeypatch.setattr(app_module, "compress_bytes", counting)
+    return app_module, calls
+
+
+def test_cached_pages_are_compressed_once_when_stored(forum):
+    app_module, calls = forum
+    client = app_module.app.test_client()
+
+    miss = client.get("/forum", headers={"Accept-Encoding": "br"})
+    assert miss.headers["X-Cache"] == "MISS"
+    assert sorted(calls) == ["br", "gzip"]
+    html = brotli.decompress(miss.get_data())
+
+    for enc in ("br", "gzip", "br"):
+        hit = client.get("/forum", headers={"Accept-Encoding": enc})
+        assert hit.headers["X-Cache"] == "HIT"
+        assert hit.headers["Content-Encoding"] == enc
+        assert hit.headers["ETag"].startswith('W/')
+    plain = client.get("/forum", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert plain.get_data() == html
+    assert sorted(calls) == ["br", "gzip"]  # nothing was recompressed on a hit
@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def progress(app_module, monkeypatch):
+    """reading_progress rows in a list; execute() stores upserts there like MySQL would."""
+    rows = []
+
+    def query_all(sql, params=(), cache_tables=None, ttl=None):
+        uid = params[0]
+        mine = [r for r in rows if r["user_id"] == uid]
+        return sorted(mine, key=lambda r: r["updated_at"], reverse=True)
+
+    def execute(sql, params=()):
+        for i in range(0, len(params), 5):
+            uid, folder, chapter, page, when = params[i:i + 5]
+            rows[:] = [r for r in rows if (r["user_id"], r["manga_folder"]) != (uid, folder)]
+            rows.append({"user_id": uid, "manga_folder": folder, "chapter": chapter, "page": page,
+                         "updated_at": when})
+
+    monkeypatch.setattr(app_module, "query_all", query_all)
+    monkeypatch.setattr(app_module, "execute", execute)
+    monkeypatch.setattr(app_module, "_ensure_flusher", lambda: None)
+    return app_module, rows
+
+
+def test_shelf_follows_writes_from_other_workers(progress):
+    app_module, rows = progress
+    uid = 4242
+    rows.append({"user_id": uid, "manga_folder": "Series", "chapter": "Chapter 1", "page": 3,
+                 "updated_at": datetime(2026, 1, 1)})
+    assert app_module.user_progress(uid)["Series"]["chapter"] == "Chapter 1"
+
+    # another worker flushes a newer beacon: the row changes and the user's progress tag is bumped
+    rows[0] = dict(rows[0], chapter="Chapter 2", page=0, updated_at=datetime(2026, 1, 2))
+    app_module.invalidate(f"progress:{uid}")
+    assert app_module.user_progress(uid)["Series"]["chapter"] == "Chapter 2"
+
+
+def test_unflushed_beacons_win_until_flushed(progress):
+    app_module, rows = progress
+    uid = 4243
+    app_module.buffer_progress(uid, "Series", "Chapter 5", 7)
+    assert app_module.user_progress(uid)["Series"] == {
+        "chapter": "Chapter 5", "page": 7, "updated_at": app_module._progress_pending[uid]["Series"][2]}
+
+    app_module.flush_progress()
+    assert app_module._progress_pending == {}
+    assert rows[0]["chapter"] == "Chapter 5"
+    assert app_module.user_progress(uid)["Series"]["page"] == 7